@@ -0,0 +1,292 @@
+"""
+Export analytique en colonnes (Parquet) : demandes, assignations et lignes de chiffrage.
+
+Jeu de données partitionné à la Hive, lisible tel quel par pandas / DuckDB / Spark :
+    exports/<table>/month=AAAA-MM/lot_type=<lot>/part-<premier id>.parquet
+
+- lecture par blocs (EXPORT_CHUNK_ROWS) sur curseur serveur (stream_results) :
+  la mémoire reste bornée quel que soit le volume ;
+- reprise : exports/_state.json garde le dernier id exporté par table, l'export suivant
+  ne traite que les nouvelles lignes. Un bloc rejoué après un crash réécrit le même
+  fichier (nom = premier id du bloc), sans doublon ;
+- les lignes déjà exportées ne sont pas revues (statut d'une assignation modifié ensuite,
+  demande archivée par la rétention) : l'export est un journal, pas un miroir ;
+- --full reconstruit chaque table dans exports/<table>.full/, substitué à l'ancien
+  répertoire à la fin seulement : pas de mélange avec les anciens fichiers, et un export
+  complet interrompu laisse l'ancien jeu intact.
+
+Nécessite pyarrow. Lancement manuel (depuis backend/) :
+    python analytics.py [--tables work_requests,quote_lines] [--full]
+Planifié : EXPORT_ENABLED=1 (job `analytics_export` relancé toutes les EXPORT_INTERVAL_S).
+"""
+import os
+import re
+import json
+import shutil
+import logging
+import argparse
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import select, Boolean, DateTime, Integer
+from sqlalchemy.orm import Session
+
+from database import WorkRequest, RequestAssignment, file_lock
+import takeoff
+
+log = logging.getLogger("coopbat.analytics")
+
+EXPORT_ENABLED = os.getenv("EXPORT_ENABLED", "0") == "1"
+EXPORT_INTERVAL_S = int(os.getenv("EXPORT_INTERVAL_S", str(24 * 3600)))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+PARTITION_VALUE_MAX = 64
+EXPORT_DIR = os.getenv(
+    "EXPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports"),
+)
+
+# colonnes internes (dédoublonnage) sans intérêt analytique
+EXCLUDED_COLUMNS = {"message_minhash"}
+REQUEST_COLUMNS = [c for c in WorkRequest.__table__.columns if c.name not in EXCLUDED_COLUMNS]
+ASSIGNMENT_COLUMNS = list(RequestAssignment.__table__.columns)
+QUOTE_SECTIONS = ("couverture_lines", "zinguerie_lines", "charpente_lines")
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+class ExportBusy(Exception):
+    pass
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("pyarrow absent : pip install pyarrow")
+    return pyarrow
+
+
+# ---------- Schémas ----------
+def _arrow_type(pa, col):
+    if isinstance(col.type, Boolean):
+        return pa.bool_()
+    if isinstance(col.type, Integer):
+        return pa.int64()
+    if isinstance(col.type, DateTime):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def schemas(pa) -> Dict[str, Any]:  # valeurs : pyarrow.Schema
+    return {
+        "work_requests": pa.schema([(c.name, _arrow_type(pa, c)) for c in REQUEST_COLUMNS]),
+        "request_assignments": pa.schema(
+            [(c.name, _arrow_type(pa, c)) for c in ASSIGNMENT_COLUMNS] + [("request_created_at", pa.timestamp("us"))]
+        ),
+        "quote_lines": pa.schema([
+            ("request_id", pa.int64()),
+            ("request_created_at", pa.timestamp("us")),
+            ("section", pa.string()),
+            ("line_no", pa.int64()),
+            ("category", pa.string()),
+            ("item_id", pa.int64()),
+            ("name", pa.string()),
+            ("qty", pa.float64()),
+            ("unit", pa.string()),
+            ("catalog_version", pa.string()),
+        ]),
+    }
+
+
+# ---------- Lecture par blocs ----------
+def _chunks(db: Session, stmt, id_col) -> Iterator[list]:
+    """Blocs de lignes d'id croissant, via un curseur serveur."""
+    result = db.execute(stmt.order_by(id_col).execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS))
+    for rows in result.partitions():
+        yield rows
+
+
+def _request_rows(db: Session, after_id: int):
+    cols = [WorkRequest.__table__.c[c.name] for c in REQUEST_COLUMNS]
+    stmt = select(*cols).where(WorkRequest.id > after_id)
+    for rows in _chunks(db, stmt, WorkRequest.id):
+        yield [dict(r._mapping) for r in rows]
+
+
+def _assignment_rows(db: Session, after_id: int):
+    stmt = (
+        select(
+            *RequestAssignment.__table__.columns,
+            WorkRequest.created_at.label("request_created_at"),
+            WorkRequest.lot_type.label("request_lot_type"),
+        )
+        .join(WorkRequest, WorkRequest.id == RequestAssignment.request_id)
+        .where(RequestAssignment.id > after_id)
+    )
+    for rows in _chunks(db, stmt, RequestAssignment.id):
+        yield [dict(r._mapping) for r in rows]
+
+
+def _quote_rows(db: Session, after_id: int):
+    """Lignes du métré V2++ de chaque demande (mémoïsé dans takeoff), une ligne par poste."""
+    cols = [WorkRequest.__table__.c[c.name] for c in REQUEST_COLUMNS]
+    stmt = select(*cols).where(WorkRequest.id > after_id)
+    for rows in _chunks(db, stmt, WorkRequest.id):
+        out = []
+        for r in rows:
+            quote = takeoff.takeoff_for_request(r)
+            for section in QUOTE_SECTIONS:
+                for n, line in enumerate(quote[section]):
+                    out.append({
+                        "id": r.id,  # curseur de reprise
+                        "request_id": r.id,
+                        "request_created_at": r.created_at,
+                        "request_lot_type": r.lot_type,
+                        "section": section[:-len("_lines")],
+                        "line_no": n,
+                        "category": line["category"],
+                        "item_id": line["item_id"],
+                        "name": line["name"],
+                        "qty": float(line["qty"]),
+                        "unit": line["unit"],
+                        "catalog_version": quote["catalog_version"],
+                    })
+        if out:
+            yield out
+
+
+# table -> (lecteur, colonne date de partition, colonne lot de partition)
+TABLES = {
+    "work_requests": (_request_rows, "created_at", "lot_type"),
+    "request_assignments": (_assignment_rows, "request_created_at", "request_lot_type"),
+    "quote_lines": (_quote_rows, "request_created_at", "request_lot_type"),
+}
+
+
+# ---------- Écriture ----------
+def _partition_key(row: dict, date_col: str, lot_col: str) -> Tuple[str, str]:
+    dt = row.get(date_col)
+    month = dt.strftime("%Y-%m") if dt else "inconnu"
+    # lot_type est du texte libre : un nom de répertoire sûr (ni "/", ni NUL, ni caractères de contrôle)
+    lot = re.sub(r"[^\w.-]+", "_", (row.get(lot_col) or "").strip())[:PARTITION_VALUE_MAX].strip("_.")
+    return month, lot or "inconnu"
+
+
+def _write_chunk(pa, schema, root: str, rows: List[dict], date_col: str, lot_col: str) -> int:
+    groups: Dict[Tuple[str, str], List[dict]] = {}
+    for row in rows:
+        groups.setdefault(_partition_key(row, date_col, lot_col), []).append(row)
+
+    first_id = rows[0]["id"]
+    for (month, lot), part in groups.items():
+        directory = os.path.join(root, f"month={month}", f"lot_type={lot}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{first_id:012d}.parquet")
+        arrow_table = pa.Table.from_pylist(part, schema=schema)
+        tmp = path + ".tmp"
+        pa.parquet.write_table(arrow_table, tmp, compression="zstd")
+        os.replace(tmp, path)
+    return len(groups)
+
+
+def _state_path() -> str:
+    return os.path.join(EXPORT_DIR, "_state.json")
+
+
+def load_state() -> dict:
+    try:
+        with open(_state_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(state: dict):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp = _state_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, _state_path())
+
+
+def _swap_in(staging: str, target: str):
+    """Remplace le répertoire `target` par `staging` (renommages, même système de fichiers)."""
+    old = target + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, old)
+    os.replace(staging, target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+@contextmanager
+def _export_lock():
+    """Un seul export à la fois (job relancé après expiration de sa visibilité, CLI...)."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with ExitStack() as stack:
+        try:
+            stack.enter_context(file_lock(os.path.join(EXPORT_DIR, ".lock"), blocking=False))
+        except BlockingIOError:
+            raise ExportBusy("export déjà en cours")
+        yield
+
+
+def run_export(db: Session, tables: List[str] = None, full: bool = False) -> dict:
+    """Exporte les nouvelles lignes de chaque table ; retourne lignes / fichiers écrits par table."""
+    pa = _pyarrow()
+    tables = tables or list(TABLES)
+    unknown = [t for t in tables if t not in TABLES]
+    if unknown:
+        raise ValueError(f"table(s) inconnue(s): {', '.join(unknown)}")
+
+    all_schemas = schemas(pa)
+    summary = {}
+    with _export_lock():
+        state = load_state()
+        for table in tables:
+            reader, date_col, lot_col = TABLES[table]
+            target = os.path.join(EXPORT_DIR, table)
+            if full:
+                root, last_id = target + ".full", 0
+                shutil.rmtree(root, ignore_errors=True)  # reste d'un export complet interrompu
+                os.makedirs(root)
+            else:
+                root, last_id = target, int(state.get(table, {}).get("last_id", 0))
+            rows_n = files_n = 0
+            for rows in reader(db, last_id):
+                files_n += _write_chunk(pa, all_schemas[table], root, rows, date_col, lot_col)
+                rows_n += len(rows)
+                last_id = rows[-1]["id"]
+                if not full:
+                    # état sauvé après chaque bloc : un export interrompu reprend ici
+                    state[table] = {"last_id": last_id, "exported_at": datetime.utcnow().isoformat(timespec="seconds")}
+                    _save_state(state)
+            if full:
+                _swap_in(root, target)
+                state[table] = {"last_id": last_id, "exported_at": datetime.utcnow().isoformat(timespec="seconds")}
+                _save_state(state)
+            summary[table] = {"rows": rows_n, "files": files_n, "last_id": last_id}
+            log.info("export %s: %d ligne(s), %d fichier(s), dernier id %d", table, rows_n, files_n, last_id)
+    db.rollback()  # referme la transaction de lecture
+    return summary
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, migrate
+
+    parser = argparse.ArgumentParser(description="Export analytique Parquet Coop'Bat")
+    parser.add_argument("--tables", default=",".join(TABLES), help="liste séparée par des virgules")
+    parser.add_argument("--full", action="store_true", help="ignore l'état et repart du début")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrate()
+    session = SessionLocal()
+    try:
+        print(run_export(session, [t.strip() for t in args.tables.split(",") if t.strip()], full=args.full))
+    finally:
+        session.close()
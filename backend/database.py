@@ -1,35 +1,154 @@
 import os
+import time
+import random
+import hashlib
 from datetime import datetime
+from contextlib import contextmanager
 
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
+    BigInteger,
     String,
     DateTime,
     Boolean,
     Text,
     ForeignKey,
+    UniqueConstraint,
+    Index,
+    Insert,
+    Update,
+    Delete,
+    inspect,
+    and_,
+    delete,
+    func,
+    select,
+    text,
+    update,
 )
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session, sessionmaker, declarative_base, relationship, deferred
+
+import geo
+
+if os.name == "nt":  # poste de dev Windows (uvicorn main:app) : pas de fcntl
+    import msvcrt
+else:
+    import fcntl
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./coop.db")
 
-# Render Postgres fournit souvent "postgres://"
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# Réplicas en lecture (optionnel), séparés par des virgules. Seules les listes et statistiques
+# y sont envoyées (main.get_replica_db : GET /requests, /admin/jobs/stats). Une demande relue par
+# son id reste sur le primaire : les clients (PWA, Kivy) ne renvoient ni cookie ni jeton, on ne
+# peut donc pas leur garantir autrement de relire leurs propres écritures.
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
 
-connect_args = {}
-if DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
+# Pool de connexions
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_S = int(os.getenv("DB_POOL_TIMEOUT_S", "30"))
+DB_POOL_RECYCLE_S = int(os.getenv("DB_POOL_RECYCLE_S", "1800"))  # -1 = jamais
+# pre-ping = un aller-retour SELECT 1 à chaque checkout ; avec un recycle court on peut s'en passer
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args=connect_args,
-    pool_pre_ping=True,
-)
+# SQLite "production" (opt-in) : WAL + pragmas appliqués à chaque connexion
+SQLITE_TUNED = os.getenv("SQLITE_TUNED", "0") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+# clé du verrou consultatif Postgres de migrate()
+MIGRATION_LOCK_ID = 0x436F6F70  # "Coop"
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+
+def normalize_url(url: str) -> str:
+    # Render Postgres fournit souvent "postgres://"
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def tune_sqlite(eng, begin: str = "BEGIN"):
+    """
+    WAL, synchronous=NORMAL, mmap, busy_timeout et cache sur chaque connexion.
+    On gère aussi BEGIN nous-mêmes (recette SQLAlchemy pour pysqlite) : SAVEPOINT
+    fiable, et BEGIN IMMEDIATE possible pour le writer.
+    """
+    @event.listens_for(eng, "connect")
+    def _on_connect(dbapi_conn, _record):
+        dbapi_conn.isolation_level = None
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.close()
+
+    @event.listens_for(eng, "begin")
+    def _on_begin(conn):
+        conn.exec_driver_sql(begin)
+
+
+def make_engine(url: str, sqlite_begin: str = "BEGIN", **overrides):
+    connect_args = {}
+    if url.startswith("sqlite"):
+        connect_args = {"check_same_thread": False}
+        if SQLITE_TUNED:
+            connect_args["timeout"] = SQLITE_BUSY_TIMEOUT_MS / 1000.0
+
+    kwargs = dict(
+        connect_args=connect_args,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_recycle=DB_POOL_RECYCLE_S,
+    )
+    # SQLite en mémoire utilise un pool mono-connexion sans taille
+    if ":memory:" not in url:
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_S)
+    kwargs.update(overrides)
+    eng = create_engine(url, **kwargs)
+    if url.startswith("sqlite") and SQLITE_TUNED:
+        tune_sqlite(eng, begin=sqlite_begin)
+    return eng
+
+
+DATABASE_URL = normalize_url(DATABASE_URL)
+engine = make_engine(DATABASE_URL)
+replica_engines = [make_engine(normalize_url(u)) for u in DATABASE_REPLICA_URLS]
+
+
+class RoutingSession(Session):
+    """
+    Session qui lit sur un réplica quand `use_replica` est vrai.
+    Toute écriture (flush, INSERT/UPDATE/DELETE) part sur le primaire,
+    et la session y reste ensuite pour relire ce qu'elle vient d'écrire.
+    """
+    use_replica = False
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.use_replica = False
+        if self.use_replica and replica_engines:
+            return random.choice(replica_engines)
+        return engine
+
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False)
+
+# Sessions des process hors API qui lisent puis écrivent (worker de jobs, rétention).
+# En WAL, une transaction différée qui a déjà lu et veut écrire après le commit d'un autre
+# process échoue aussitôt (SQLITE_BUSY_SNAPSHOT, busy_timeout ne s'applique pas) :
+# BEGIN IMMEDIATE prend le verrou d'écriture dès le début et attend son tour.
+if DATABASE_URL.startswith("sqlite") and SQLITE_TUNED:
+    worker_engine = make_engine(DATABASE_URL, sqlite_begin="BEGIN IMMEDIATE")
+    WorkerSession = sessionmaker(bind=worker_engine, autocommit=False, autoflush=False)
+else:
+    worker_engine, WorkerSession = engine, SessionLocal
 Base = declarative_base()
 
 
@@ -42,9 +161,6 @@ class ProUser(Base):
     password_hash = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-    # relation: demandes prises en charge
-    assignments = relationship("RequestAssignment", back_populates="artisan", cascade="all, delete-orphan")
-
 
 class ArtisanUser(Base):
     __tablename__ = "artisan_users"
@@ -55,7 +171,14 @@ class ArtisanUser(Base):
     password_hash = Column(String, nullable=False)
 
     commune = Column(String, nullable=False, default="")
-    radius_km = Column(Integer, nullable=False, default=0)
+    commune_id = Column(String, nullable=True, index=True)  # code INSEE (geo.py)
+    radius_km = Column(Integer, nullable=False, default=0)  # saisie des anciens clients : > 0 = tout le département
+    # zone d'intervention : sa commune, ou tout son département. Pas de rayon en km : le
+    # référentiel des communes n'a pas de coordonnées.
+    whole_departement = Column(Boolean, nullable=True, default=False)
+    # clés de correspondance avec les demandes (geo.zone_keys), filtrées en SQL par notifications.py
+    commune_key = Column(String, nullable=True, index=True)
+    departement = Column(String, nullable=True, index=True)
     phone = Column(String, nullable=True, default="")
     zone_note = Column(String, nullable=True, default="")
 
@@ -80,6 +203,7 @@ class WorkRequest(Base):
     name = Column(String, nullable=False)
     email = Column(String, nullable=False)
     commune = Column(String, nullable=False)
+    commune_id = Column(String, nullable=True, index=True)  # code INSEE (geo.py)
 
     # lot / infos générales
     lot_type = Column(String, nullable=False, default="")  # "lot" / "charpente" / "couverture" / "zinguerie"
@@ -103,6 +227,13 @@ class WorkRequest(Base):
     # Charpente (liste simple d’options cochées)
     charp_options = Column(String, nullable=True, default="")  # ex: "renovation;extension;..."
 
+    # Doublons (dedup.py) : empreinte normalisée + signature MinHash du message
+    fingerprint = Column(String, nullable=True, index=True)
+    # ~1 Ko de hex, lu par dedup.py seulement : hors des SELECT de liste / détail
+    message_minhash = deferred(Column(Text, nullable=True), raiseload=True)
+    duplicate_of = Column(Integer, nullable=True, index=True)  # id de la demande d'origine
+    possible_duplicate_of = Column(Integer, nullable=True)  # message proche, autre email : signalé seulement
+
     # Assignation artisan (optionnelle)
     assignments = relationship("RequestAssignment", back_populates="request", cascade="all, delete-orphan")
 
@@ -124,4 +255,225 @@ class RequestAssignment(Base):
     artisan = relationship("ArtisanUser", back_populates="assignments")
 
 
-Base.metadata.create_all(bind=engine)
+# jobs coalescés (jobs.ensure_pending) : au plus un "pending" par type, garanti par la base
+COALESCED_JOB_KINDS = ("purge_jobs", "retention", "analytics_export", "send_digests")
+_PENDING_COALESCED = text(
+    "status = 'pending' AND kind IN (%s)" % ", ".join(f"'{k}'" for k in COALESCED_JOB_KINDS)
+)
+
+
+class Job(Base):
+    """
+    File de travaux en arrière-plan (archive JSON, notifications, pré-chiffrage).
+    Un job "running" dont locked_until est dépassé redevient réclamable (visibility timeout).
+    """
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # purge et échantillon de latence (queue_stats) : jobs terminés par date de fin
+        Index("ix_jobs_status_finished", "status", "finished_at"),
+        # index partiel sur "pending" seulement : un job périodique en cours doit pouvoir
+        # programmer le suivant
+        Index("uq_jobs_pending_kind", "kind", unique=True,
+              sqlite_where=_PENDING_COALESCED, postgresql_where=_PENDING_COALESCED),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False, index=True)  # archive_lead / notify_artisans / ...
+    payload = Column(Text, nullable=False, default="{}")  # JSON
+
+    status = Column(String, nullable=False, default="pending", index=True)  # pending / running / done / failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    last_error = Column(Text, nullable=True, default="")
+
+    run_after = Column(DateTime, default=datetime.utcnow, index=True)
+    locked_until = Column(DateTime, nullable=True)
+    locked_by = Column(String, nullable=True, default="")
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class Notification(Base):
+    """
+    Outbox des notifications artisan : une ligne par (artisan, demande, canal).
+    La contrainte unique empêche de notifier deux fois la même demande au même artisan.
+    """
+    __tablename__ = "notifications"
+    __table_args__ = (UniqueConstraint("artisan_id", "request_id", "channel", name="uq_notification_once"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    artisan_id = Column(Integer, ForeignKey("artisan_users.id", ondelete="CASCADE"), nullable=False, index=True)
+    request_id = Column(Integer, ForeignKey("work_requests.id", ondelete="CASCADE"), nullable=False)
+    channel = Column(String, nullable=False, default="email")
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    batch_id = Column(String, nullable=True, index=True)  # digest en cours d'envoi
+    claimed_at = Column(DateTime, nullable=True)
+    sent_at = Column(DateTime, nullable=True, index=True)
+
+
+class LeadBand(Base):
+    """
+    Bandes LSH de la signature MinHash d'un message (dedup.py) : deux messages proches
+    partagent au moins une bande, retrouvée par l'index sans parcourir la table.
+    """
+    __tablename__ = "lead_bands"
+    # (bande, demande) : les dernières demandes d'une bande se lisent sans trier toutes ses lignes
+    __table_args__ = (Index("ix_lead_bands_band_request", "band", "request_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    request_id = Column(Integer, ForeignKey("work_requests.id", ondelete="CASCADE"), nullable=False, index=True)
+    band = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchivedRequest(Base):
+    """
+    Index des demandes sorties de la table chaude par la rétention (retention.py).
+    Permet de retrouver une demande archivée par son id sans parcourir les archives.
+    """
+    __tablename__ = "archived_requests"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # = work_requests.id d'origine
+    created_at = Column(DateTime, nullable=False)
+    month = Column(String, nullable=False, index=True)  # "2025_01"
+    storage = Column(String, nullable=False, default="file")  # partition / file
+    # fichier : position du membre gzip (un par lot) contenant la demande, lu seul à la relecture
+    member_offset = Column(BigInteger, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SchemaMigration(Base):
+    """Versions de schéma appliquées (empreinte des tables/colonnes/index, cf. migrate())."""
+    __tablename__ = "schema_migrations"
+
+    version = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+# ---------- Migration (une fois, au démarrage) ----------
+def schema_version() -> str:
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts += [f"{table.name}.{c.name}:{c.type}" for c in table.columns]
+        parts += [f"{table.name}#{i.name}" for i in table.indexes]
+    return hashlib.sha1("\n".join(sorted(parts)).encode()).hexdigest()[:16]
+
+
+def _schema_is_current(eng, version: str) -> bool:
+    try:
+        with eng.connect() as conn:
+            return conn.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :v"), {"v": version}
+            ).first() is not None
+    except (OperationalError, ProgrammingError):  # table absente : base neuve
+        return False
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    """
+    Verrou exclusif inter-process sur `path` (flock sous POSIX, msvcrt.locking sous Windows).
+    Non bloquant : lève BlockingIOError si le verrou est déjà pris.
+    """
+    with open(path, "a+") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if not blocking:
+                        raise BlockingIOError(f"verrou déjà pris: {path}")
+                    time.sleep(0.1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _migration_lock(eng):
+    """Verrou inter-process : un seul worker migre, les autres attendent puis constatent."""
+    if eng.dialect.name == "postgresql":
+        with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_ID})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_ID})
+    elif eng.dialect.name == "sqlite" and eng.url.database not in (None, "", ":memory:"):
+        with file_lock(f"{eng.url.database}.migrate.lock"):
+            yield
+    else:
+        yield
+
+
+def migrate(eng=engine) -> bool:
+    """
+    Crée / complète le schéma s'il n'est pas à jour. Sans effet (une requête) quand la version
+    courante est déjà enregistrée. Retourne True si une migration a eu lieu.
+    """
+    version = schema_version()
+    if _schema_is_current(eng, version):
+        return False
+    with _migration_lock(eng):
+        if _schema_is_current(eng, version):  # migré par un autre process pendant l'attente
+            return False
+        Base.metadata.create_all(bind=eng)
+        coalesce_pending_jobs(eng)
+        add_missing_columns(eng)
+        fill_artisan_zones(eng)
+        with eng.begin() as conn:
+            conn.execute(SchemaMigration.__table__.insert().values(version=version, applied_at=datetime.utcnow()))
+    return True
+
+
+def coalesce_pending_jobs(eng=engine):
+    """Doublons "pending" d'avant uq_jobs_pending_kind : on garde le plus ancien de chaque type."""
+    pending = and_(Job.status == "pending", Job.kind.in_(COALESCED_JOB_KINDS))
+    with eng.begin() as conn:
+        conn.execute(
+            delete(Job).where(pending, Job.id.not_in(select(func.min(Job.id)).where(pending).group_by(Job.kind)))
+        )
+
+
+def fill_artisan_zones(eng=engine):
+    """Zone des artisans inscrits avant les colonnes whole_departement / commune_key / departement."""
+    with eng.begin() as conn:
+        rows = conn.execute(
+            select(ArtisanUser.id, ArtisanUser.commune, ArtisanUser.commune_id, ArtisanUser.radius_km)
+            .where(ArtisanUser.commune_key.is_(None))
+        ).all()
+        for r in rows:
+            conn.execute(
+                update(ArtisanUser)
+                .where(ArtisanUser.id == r.id)
+                .values(whole_departement=(r.radius_km or 0) > 0, **geo.zone_keys(r.commune, r.commune_id))
+            )
+
+
+def add_missing_columns(eng=engine):
+    """create_all ne modifie pas une table existante : ajoute les colonnes (nullables) et index manquants."""
+    insp = inspect(eng)
+    with eng.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            added = [col for col in table.columns if col.name not in existing]
+            for col in added:
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN "{col.name}" {col.type.compile(dialect=conn.dialect)}'
+                ))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
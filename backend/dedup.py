@@ -0,0 +1,200 @@
+"""
+Détection des demandes en double (POST /requests puis job `dedup_lead`).
+
+Deux contrôles, chacun en O(1) requêtes indexées :
+- empreinte exacte, à l'insertion : sha1(email, commune, lot, surfaces arrondies, tranche
+  de temps), stockée dans work_requests.fingerprint ; on cherche la tranche courante et la
+  précédente pour ne pas rater deux envois de part et d'autre d'une frontière ;
+- message proche, dans le job `dedup_lead` (hors de la requête HTTP) : signature MinHash des
+  4-grammes de caractères du message, découpée en bandes LSH (table lead_bands). Les demandes
+  antérieures qui partagent une bande sont comparées signature contre signature. Même email
+  -> doublon ; autre email mais même commune -> seulement "doublon possible" (deux voisins
+  peuvent décrire le même chantier type). Le job n'enchaîne archive / notification /
+  chiffrage qu'après ce verdict.
+
+DEDUP_MODE=flag (défaut) : la demande est enregistrée avec duplicate_of et n'est pas notifiée.
+DEDUP_MODE=merge : pour une empreinte identique, rien n'est inséré et la demande d'origine
+est renvoyée ; un message proche (connu après la réponse) est toujours signalé.
+Un doublon possible est toujours inséré, listé et notifié, avec possible_duplicate_of.
+"""
+import os
+import re
+import random
+import struct
+import hashlib
+import unicodedata
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, insert, select, union_all
+from sqlalchemy.orm import Session
+
+from database import WorkRequest, LeadBand
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_MODE = os.getenv("DEDUP_MODE", "flag")  # flag / merge
+DEDUP_WINDOW_H = int(os.getenv("DEDUP_WINDOW_H", "24"))  # tranche de temps de l'empreinte
+DEDUP_FUZZY_DAYS = int(os.getenv("DEDUP_FUZZY_DAYS", "30"))
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", "0.8"))  # Jaccard estimé minimal
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bandes de 4 lignes : rappel ~100 % à 0.8, ~12 % de candidats à 0.3 (écartés ensuite)
+SHINGLE_SIZE = 4
+MIN_MESSAGE_CHARS = 20  # "test", "ok"... : trop court pour une comparaison floue
+CANDIDATES_PER_BAND = 3
+
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(20240501)  # fixe : les signatures stockées doivent rester comparables
+_PERMS = [(_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE)) for _ in range(MINHASH_PERMUTATIONS)]
+
+
+# ---------- Normalisation ----------
+def _norm(value: str) -> str:
+    value = unicodedata.normalize("NFKD", (value or "").strip().lower())
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9@.]+", " ", value).split())
+
+
+def _surface(value) -> str:
+    try:
+        return str(int(round(float(str(value or "").replace(",", ".").strip() or 0))))
+    except (ValueError, OverflowError):  # "abc", "nan" / "inf", "1e400"
+        return ""
+
+
+def time_bucket(dt: datetime) -> int:
+    return int(dt.timestamp() // (DEDUP_WINDOW_H * 3600))
+
+
+# ---------- Empreinte exacte ----------
+def fingerprint(fields: dict, bucket: int) -> str:
+    parts = [
+        _norm(fields.get("email")),
+        _norm(fields.get("commune")),
+        _norm(fields.get("lot_type")),
+        _surface(fields.get("surface_m2")),
+        _surface(fields.get("cover_surface_m2")),
+        str(bucket),
+    ]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+# ---------- MinHash / LSH ----------
+def minhash(message: str) -> Optional[List[int]]:
+    text = _norm(message)
+    if len(text) < MIN_MESSAGE_CHARS:
+        return None
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = [
+        struct.unpack("<Q", hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest())[0]
+        for sh in shingles
+    ]
+    return [min((a * h + b) % _MERSENNE for h in hashes) for a, b in _PERMS]
+
+
+def encode_signature(sig: List[int]) -> str:
+    return "".join(f"{v:016x}" for v in sig)
+
+
+def bands(sig: List[int]) -> List[str]:
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    out = []
+    for i in range(LSH_BANDS):
+        chunk = ",".join(str(v) for v in sig[i * rows:(i + 1) * rows])
+        out.append(f"{i}:{hashlib.sha1(chunk.encode()).hexdigest()[:16]}")
+    return out
+
+
+# ---------- Contrôles ----------
+# requêtes construites une fois : seules les valeurs changent d'un appel à l'autre
+# (l'union de 16 sous-requêtes coûte bien plus à assembler qu'à exécuter)
+_SAME_FINGERPRINT = (
+    select(WorkRequest.id, WorkRequest.duplicate_of)
+    .where(WorkRequest.fingerprint.in_([bindparam("fp"), bindparam("fp_prev")]))
+    .order_by(WorkRequest.id)
+    .limit(1)
+)
+# les plus récentes de chaque bande seulement : coût borné même pour un message très répandu
+_BAND_CANDIDATES = union_all(*[
+    select(sq.c.request_id) for sq in (
+        select(LeadBand.request_id)
+        .where(LeadBand.band == bindparam(f"band_{i}"), LeadBand.created_at >= bindparam("since"))
+        .order_by(LeadBand.request_id.desc())
+        .limit(CANDIDATES_PER_BAND)
+        .subquery()
+        for i in range(LSH_BANDS)
+    )
+])
+_CANDIDATES = (
+    select(WorkRequest.id, WorkRequest.duplicate_of, WorkRequest.email,
+           WorkRequest.commune, WorkRequest.message_minhash)
+    .where(WorkRequest.id.in_(_BAND_CANDIDATES), WorkRequest.id < bindparam("request_id"))
+    .order_by(WorkRequest.id)
+)
+
+
+def _similar(sig_hex: str, other_hex: str) -> bool:
+    """Jaccard estimé sur les signatures encodées (comparaison des tranches hex, sans décodage)."""
+    if len(other_hex) != len(sig_hex):
+        return False
+    same = sum(sig_hex[i:i + 16] == other_hex[i:i + 16] for i in range(0, len(sig_hex), 16))
+    return same / MINHASH_PERMUTATIONS >= DEDUP_SIMILARITY
+
+
+def find_duplicate(db: Session, fields: dict, now: Optional[datetime] = None) -> Tuple[Optional[int], str]:
+    """
+    Contrôle à l'insertion, empreinte exacte seulement (une requête indexée).
+    Retourne (id de la demande d'origine ou None, empreinte à stocker).
+    """
+    now = now or datetime.utcnow()
+    bucket = time_bucket(now)
+    fp = fingerprint(fields, bucket)
+    if not DEDUP_ENABLED:
+        return None, fp
+    same = db.execute(_SAME_FINGERPRINT, {"fp": fp, "fp_prev": fingerprint(fields, bucket - 1)}).first()
+    if same is None:
+        return None, fp
+    return same.duplicate_of or same.id, fp
+
+
+def _find_similar(db: Session, req: WorkRequest, sig: List[int]) -> Tuple[Optional[int], Optional[int]]:
+    """(doublon, doublon possible) parmi les demandes antérieures au message proche."""
+    params = {f"band_{i}": band for i, band in enumerate(bands(sig))}
+    params["since"] = (req.created_at or datetime.utcnow()) - timedelta(days=DEDUP_FUZZY_DAYS)
+    params["request_id"] = req.id
+    sig_hex = encode_signature(sig)
+    email, commune = _norm(req.email), _norm(req.commune)
+    possible = None
+    for c in db.execute(_CANDIDATES, params):
+        if not c.message_minhash or not _similar(sig_hex, c.message_minhash):
+            continue
+        if _norm(c.email) == email:
+            return c.duplicate_of or c.id, None
+        if possible is None and _norm(c.commune) == commune:
+            possible = c.duplicate_of or c.id
+    return None, possible
+
+
+def check_similar(db: Session, req: WorkRequest) -> bool:
+    """
+    Contrôle flou d'une demande déjà enregistrée (job `dedup_lead`, sans commit) :
+    renseigne duplicate_of / possible_duplicate_of, la signature et les bandes LSH.
+    Rejouable. Retourne True si la demande est un doublon (ni notifiée ni chiffrée).
+    """
+    sig = minhash(req.message or "")
+    if sig is None:
+        return req.duplicate_of is not None
+    if DEDUP_ENABLED and req.duplicate_of is None:
+        req.duplicate_of, req.possible_duplicate_of = _find_similar(db, req, sig)
+    req.message_minhash = encode_signature(sig)
+    register(db, req.id, sig)
+    return req.duplicate_of is not None
+
+
+def register(db: Session, request_id: int, sig: Optional[List[int]]):
+    """Indexe les bandes LSH d'une demande (un seul INSERT multi-lignes ; rejouable)."""
+    if sig is None:
+        return
+    now = datetime.utcnow()
+    db.execute(delete(LeadBand).where(LeadBand.request_id == request_id))
+    db.execute(insert(LeadBand), [{"request_id": request_id, "band": b, "created_at": now} for b in bands(sig)])
@@ -0,0 +1,309 @@
+"""
+Documents de devis (HTML / PDF) générés à partir d'un payload de chiffrage avancé
+(format des archives advanced_*.json : V2 avec couverture_2.lines..., ou V2++ avec
+couverture_lines / zinguerie_lines / charpente_lines).
+
+Stockage adressé par contenu : le nom du fichier est le sha256 du payload canonique
++ version du catalogue (CHIFFRAGE.xlsx) + version du gabarit. Un devis déjà rendu est
+servi directement depuis le disque ; le rendu tourne dans un pool de process (spawn),
+hors du thread de la requête.
+
+Le dossier est borné à DEVIS_MAX_BYTES : chaque accès rafraîchit la date de modification
+du fichier, et après une écriture les fichiers les moins récemment utilisés sont supprimés
+(au plus un balayage par DEVIS_SWEEP_INTERVAL_S et par process). Un rendu évincé est refait
+depuis son payload ; un payload évincé rend le devis introuvable (404).
+
+Derrière nginx, DEVIS_ACCEL_PREFIX (ex. "/_devis/") délègue l'envoi du fichier
+à nginx (X-Accel-Redirect : sendfile noyau + Range).
+"""
+import os
+import re
+import json
+import html
+import uuid
+import hashlib
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Optional
+
+DEVIS_DIR = os.getenv(
+    "DEVIS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives", "devis"),
+)
+DEVIS_RENDER_WORKERS = int(os.getenv("DEVIS_RENDER_WORKERS", "2"))
+DEVIS_ACCEL_PREFIX = os.getenv("DEVIS_ACCEL_PREFIX", "")
+# taille max du corps de POST /devis, et du dossier des devis (payloads + rendus)
+DEVIS_MAX_BODY_BYTES = int(os.getenv("DEVIS_MAX_BODY_BYTES", str(256 * 1024)))
+DEVIS_MAX_BYTES = int(os.getenv("DEVIS_MAX_BYTES", str(512 * 1024 * 1024)))
+DEVIS_SWEEP_INTERVAL_S = float(os.getenv("DEVIS_SWEEP_INTERVAL_S", "30"))
+
+TEMPLATE_VERSION = "2"
+FORMATS = {"html": "text/html; charset=utf-8", "pdf": "application/pdf"}
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+# ---------- Adressage ----------
+def content_hash(payload: dict, catalog_version: str) -> str:
+    canonical = json.dumps(
+        {"payload": payload, "catalog": catalog_version, "template": TEMPLATE_VERSION},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def document_path(digest: str, fmt: str) -> str:
+    if not HASH_RE.match(digest) or (fmt not in FORMATS and fmt != "json"):
+        raise ValueError("référence de devis invalide")
+    return os.path.join(DEVIS_DIR, digest[:2], f"{digest}.{fmt}")
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)  # atomique : deux rendus concurrents du même devis ne se gênent pas
+    evict_if_needed()
+
+
+def touch(path: str) -> bool:
+    """Marque le fichier comme utilisé (ordre LRU). False s'il n'existe pas (ou plus)."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+# ---------- Éviction (LRU sur la date de modification) ----------
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+def _files():
+    for sub in os.scandir(DEVIS_DIR):
+        if sub.is_dir():
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    yield st.st_mtime, st.st_size, entry.path
+
+
+def evict(max_bytes: int = DEVIS_MAX_BYTES) -> int:
+    """Supprime les fichiers les moins récemment utilisés si le dossier dépasse max_bytes. Retourne leur nombre."""
+    if not os.path.isdir(DEVIS_DIR):
+        return 0
+    files = sorted(_files())
+    total = sum(size for _, size, _ in files)
+    if total <= max_bytes:
+        return 0
+    target = max_bytes * 0.9  # marge : les écritures suivantes ne redéclenchent pas tout de suite
+    removed = 0
+    for _, size, path in files:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # évincé par un autre process
+        total -= size
+        removed += 1
+    return removed
+
+
+def evict_if_needed():
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < DEVIS_SWEEP_INTERVAL_S or not _sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _last_sweep = now
+        evict()
+    finally:
+        _sweep_lock.release()
+
+
+def store_source(payload: dict, catalog_version: str) -> str:
+    """Enregistre le payload (une fois) et retourne son empreinte ; les rendus en découlent."""
+    digest = content_hash(payload, catalog_version)
+    path = document_path(digest, "json")
+    if not touch(path):
+        _write_atomic(path, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    return digest
+
+
+def load_source(digest: str) -> Optional[dict]:
+    try:
+        with open(document_path(digest, "json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# ---------- Mise en forme ----------
+def devis_lines(payload: dict) -> List[dict]:
+    """Toutes les lignes de chiffrage, quel que soit le format (V2 ou V2++)."""
+    inner = payload.get("payload", payload)
+    lines = []
+    for key in ("couverture_lines", "zinguerie_lines", "charpente_lines"):
+        lines += inner.get(key) or []
+    for key in ("couverture_2", "zinguerie_2", "charpente_2"):
+        lines += (inner.get(key) or {}).get("lines") or []
+    return lines
+
+
+def _qty(q) -> str:
+    try:
+        q = float(q)
+    except (TypeError, ValueError):
+        return str(q or "")
+    return f"{q:.2f}".rstrip("0").rstrip(".").replace(".", ",")
+
+
+def _header(payload: dict) -> dict:
+    return {
+        "name": payload.get("contact_name", ""),
+        "commune": payload.get("contact_commune", ""),
+        "email": payload.get("contact_email", ""),
+        "message": (payload.get("payload") or {}).get("message", "") or payload.get("message", ""),
+        # date du document (haché avec lui), jamais celle du rendu
+        "date": payload.get("date") or "",
+    }
+
+
+def render_html(payload: dict) -> bytes:
+    h = _header(payload)
+    e = html.escape
+    rows = "\n".join(
+        f"<tr><td>{e(str(l.get('category', '')))}</td><td>{e(str(l.get('name', '')))}</td>"
+        f"<td class=\"num\">{e(_qty(l.get('qty')))}</td><td>{e(str(l.get('unit', '')))}</td></tr>"
+        for l in devis_lines(payload)
+    )
+    doc = f"""<!doctype html>
+<html lang="fr"><head><meta charset="utf-8"><title>Devis Coop'Bat</title>
+<style>
+body {{ font-family: Helvetica, Arial, sans-serif; margin: 2em; color: #222; }}
+table {{ border-collapse: collapse; width: 100%; }}
+th, td {{ border-bottom: 1px solid #ddd; padding: 6px; text-align: left; }}
+td.num {{ text-align: right; }}
+</style></head><body>
+<h1>Devis Coop'Bat</h1>
+<p>{e(h['name'])} &mdash; {e(h['commune'])} &mdash; {e(h['email'])}<br>Date : {e(h['date'])}</p>
+<table><thead><tr><th>Lot</th><th>Désignation</th><th>Qté</th><th>Unité</th></tr></thead>
+<tbody>
+{rows}
+</tbody></table>
+<p>{e(h['message'])}</p>
+<p><small>Quantités indicatives, à confirmer par l'artisan après visite.</small></p>
+</body></html>
+"""
+    return doc.encode("utf-8")
+
+
+def _pdf_text(s: str) -> bytes:
+    raw = s.encode("cp1252", errors="replace")
+    return raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def render_pdf(payload: dict) -> bytes:
+    """PDF texte minimal (Courier, WinAnsi : colonnes alignées en chasse fixe), sans dépendance externe."""
+    h = _header(payload)
+    text_lines = [
+        ("Devis Coop'Bat", 16),
+        (f"{h['name']} - {h['commune']} - {h['email']}", 10),
+        (f"Date : {h['date']}", 10),
+        ("", 10),
+    ]
+    for l in devis_lines(payload):
+        text_lines.append((
+            f"{str(l.get('category', '')):<12} {str(l.get('name', ''))[:60]:<60} "
+            f"{_qty(l.get('qty')):>10} {l.get('unit', '')}", 9,
+        ))
+    if h["message"]:
+        text_lines += [("", 10), (h["message"][:100], 10)]
+    text_lines += [("", 10), ("Quantités indicatives, à confirmer par l'artisan après visite.", 8)]
+
+    per_page = 60
+    pages = [text_lines[i:i + per_page] for i in range(0, len(text_lines), per_page)] or [[]]
+
+    objects: List[bytes] = []  # objets 1..n
+
+    def add(obj: bytes) -> int:
+        objects.append(obj)
+        return len(objects)
+
+    add(b"<< /Type /Catalog /Pages 2 0 R >>")
+    add(b"")  # /Pages, complété plus bas
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>")
+    page_ids = []
+    for lines in pages:
+        ops = [b"BT", b"50 800 Td"]
+        for text, size in lines:
+            ops.append(b"/F1 %d Tf %d TL (%s) Tj T*" % (size, size + 3, _pdf_text(text)))
+        ops.append(b"ET")
+        stream = b"\n".join(ops)
+        content = add(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        page_ids.append(add(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font, content)
+        ))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+RENDERERS = {"html": render_html, "pdf": render_pdf}
+
+
+# ---------- Rendu (process du pool) ----------
+def render_to_file(payload: dict, digest: str, fmt: str) -> str:
+    path = document_path(digest, fmt)
+    if touch(path):
+        return path
+    _write_atomic(path, RENDERERS[fmt](payload))
+    return path
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn : pas de fork d'un process API déjà multi-thread (writer SQLite, pool SMTP...)
+            _pool = ProcessPoolExecutor(max_workers=DEVIS_RENDER_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def ensure_rendered(payload: dict, digest: str, fmt: str) -> Future:
+    """Future du chemin du document ; déjà résolue si le fichier existe."""
+    path = document_path(digest, fmt)
+    if touch(path):
+        fut: Future = Future()
+        fut.set_result(path)
+        return fut
+    return get_pool().submit(render_to_file, payload, digest, fmt)
@@ -0,0 +1,397 @@
+"""
+Référentiel des communes (code INSEE + code postal) pour l'autocomplétion et la
+normalisation des champs `commune` (demandes, artisans).
+
+Source livrée : communes.csv.gz (colonnes du fichier La Poste : code INSEE ; nom ; code postal),
+tirée du code officiel géographique de l'INSEE et de la base officielle des codes postaux
+de La Poste (Licence Ouverte). Pour la rafraîchir depuis le fichier officiel :
+https://www.data.gouv.fr/fr/datasets/base-officielle-des-codes-postaux/
+    python geo.py build laposte_hexasmal.csv      # -> communes.idx
+
+communes.idx (non versionné) est compilé depuis la source au premier chargement, et recompilé
+quand la source est plus récente. Il est ouvert en mmap (partagé entre workers par le cache
+disque) : tableaux triés de longueur fixe + une zone de chaînes, recherche par dichotomie.
+- chiffres : préfixe de code postal ("316" -> 31600 Muret, ...) ;
+- texte : préfixe du nom normalisé (sans accents, "saint" = "st"), puis préfixe d'un mot
+  du nom ("orens" -> St Orens de Gameville). Les noms en "st"/"ste" sont aussi indexés
+  en toutes lettres : "sai", "sain" trouvent déjà les Saint-... en cours de frappe.
+  Une entrée par commune, classées avant troncature : nom complet avant mot intérieur,
+  nom exact d'abord, puis les communes à plusieurs codes postaux (faute de population dans
+  la source, c'est ce qui distingue Toulouse de Toulaud), puis ordre naturel ("Paris 2e"
+  avant "Paris 10e").
+
+Paris, Lyon et Marseille ne figurent dans le fichier La Poste que par leurs arrondissements
+municipaux : la ville (75056, 69123, 13055) est ajoutée à la compilation, avec les codes
+postaux de ses arrondissements.
+
+Format (little-endian) :
+    en-tête  : MAGIC, nb communes, nb clés "nom", nb clés "mot", taille des chaînes
+    communes : (insee 5s, code postal 5s, offset nom u32, longueur nom u16, poids u16),
+               triées par code postal ; poids = nombre de codes postaux de la commune
+    insee    : index u32 des communes, triés par code INSEE
+    noms     : (offset clé u32, longueur clé u16, index commune u32), triés par clé
+    mots     : idem pour les mots du nom (sauf le premier)
+    chaînes  : noms affichés et clés normalisées (utf-8)
+"""
+import os
+import re
+import csv
+import gzip
+import mmap
+import struct
+import logging
+import argparse
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional
+
+log = logging.getLogger("coopbat.geo")
+
+GEO_INDEX_PATH = os.getenv(
+    "GEO_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "communes.idx"),
+)
+GEO_SOURCE_PATH = os.getenv(
+    "GEO_SOURCE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "communes.csv.gz"),
+)
+GEO_MAX_RESULTS = 10
+# entrées de préfixe examinées avant classement (saisies d'une ou deux lettres)
+GEO_SCAN_MAX = 1000
+
+MAGIC = b"CBGEO2\0\0"
+HEADER = struct.Struct("<8sIIII")
+COMMUNE = struct.Struct("<5s5sIHH")
+KEY = struct.Struct("<IHI")
+U32 = struct.Struct("<I")
+
+_ABBREVIATIONS = {"saint": "st", "sainte": "ste"}
+_EXPANSIONS = {v: k for k, v in _ABBREVIATIONS.items()}
+
+# ville -> (nom, préfixe INSEE de ses arrondissements municipaux)
+_ARRONDISSEMENTS = {"75056": ("Paris", "751"), "69123": ("Lyon", "6938"), "13055": ("Marseille", "132")}
+
+
+# ---------- Normalisation ----------
+def normalize(value: str) -> str:
+    value = unicodedata.normalize("NFKD", (value or "").strip().lower())
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    words = re.sub(r"[^a-z0-9]+", " ", value).split()
+    return " ".join(_ABBREVIATIONS.get(w, w) for w in words)
+
+
+def departement(value: str) -> str:
+    """Département d'un code postal ou d'un code INSEE (Corse : 2A/2B comptés comme 20, comme les codes postaux)."""
+    v = (value or "").strip().upper()
+    if len(v) == 5 and v[:2] in ("2A", "2B") and v[2:].isdigit():
+        return "20"
+    if len(v) == 5 and v.isdigit():
+        return v[:3] if v.startswith("97") else v[:2]
+    return ""
+
+
+def zone_keys(commune: str, commune_id: Optional[str] = None) -> Dict[str, str]:
+    """Clés de correspondance artisan / demande : nom (ou code postal) normalisé et département."""
+    return {"commune_key": normalize(commune), "departement": departement(commune_id) or departement(commune)}
+
+
+def _natural(key: str) -> list:
+    """Clé de tri "naturel" : les nombres comparés comme des nombres (1er < 2e < 10e)."""
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", key)]
+
+
+def _key_variants(key: str) -> List[str]:
+    """Clé normalisée + sa forme "saint"/"sainte" en toutes lettres (saisie partielle "sain")."""
+    words = key.split(" ")
+    expanded = " ".join(_EXPANSIONS.get(w, w) for w in words)
+    return [key] if expanded == key else [key, expanded]
+
+
+# ---------- Construction ----------
+def _column(header: List[str], *needles: str, exclude: str = "") -> int:
+    for i, name in enumerate(header):
+        n = normalize(name)
+        if any(k in n for k in needles) and not (exclude and exclude in n):
+            return i
+    raise ValueError(f"colonne introuvable ({'/'.join(needles)}) dans {header}")
+
+
+def _read_rows(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    for encoding in ("utf-8-sig", "latin-1"):
+        try:
+            with opener(path, "rt", encoding=encoding, newline="") as f:
+                sample = f.read(4096)
+                f.seek(0)
+                reader = csv.reader(f, delimiter=";" if sample.count(";") > sample.count(",") else ",")
+                return list(reader)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"encodage non reconnu: {path}")
+
+
+def build_index(csv_path: str, out_path: str = GEO_INDEX_PATH) -> int:
+    rows = _read_rows(csv_path)
+    header, rows = rows[0], rows[1:]
+    c_insee = _column(header, "insee")
+    c_name = _column(header, "nom", "libelle", exclude="acheminement")
+    c_cp = _column(header, "postal")
+
+    # une entrée par couple (commune, code postal) ; les lieux-dits (ligne 5) sont ignorés
+    seen = set()
+    communes = []
+    for row in rows:
+        if len(row) <= max(c_insee, c_name, c_cp):
+            continue
+        insee, name, cp = row[c_insee].strip().upper(), row[c_name].strip(), row[c_cp].strip()
+        if len(insee) != 5 or len(cp) != 5 or not name or (insee, cp) in seen:
+            continue
+        seen.add((insee, cp))
+        communes.append((cp, normalize(name), insee, name))
+
+    for city, (name, prefix) in _ARRONDISSEMENTS.items():
+        for cp in sorted({cp for cp, _, insee, _ in communes if insee.startswith(prefix)}):
+            if (city, cp) not in seen:
+                seen.add((city, cp))
+                communes.append((cp, normalize(name), city, name))
+    communes.sort()
+
+    postcodes = Counter(insee for _, _, insee, _ in communes)
+    arrondissement_prefixes = tuple(prefix for _, prefix in _ARRONDISSEMENTS.values())
+
+    strings = bytearray()
+
+    def intern(s: str):
+        raw = s.encode("utf-8")
+        off = len(strings)
+        strings.extend(raw)
+        return off, len(raw)
+
+    commune_recs = bytearray()
+    name_keys, word_keys = [], []
+    for idx, (cp, key, insee, name) in enumerate(communes):
+        off, length = intern(name)
+        # un arrondissement pèse comme une petite commune : c'est la ville qui porte le poids
+        weight = 1 if insee.startswith(arrondissement_prefixes) else min(postcodes[insee], 0xFFFF)
+        commune_recs += COMMUNE.pack(insee.encode("ascii"), cp.encode("ascii"), off, length, weight)
+        name_keys += [(k, idx) for k in _key_variants(key)]
+        words = key.split(" ")
+        for i in range(1, len(words)):
+            word_keys += [(k, idx) for k in _key_variants(" ".join(words[i:]))]
+
+    def pack_keys(keys):
+        out = bytearray()
+        for key, idx in sorted(keys):
+            off, length = intern(key)
+            out += KEY.pack(off, length, idx)
+        return out
+
+    names = pack_keys(name_keys)
+    words = pack_keys(word_keys)
+    insee_order = sorted(range(len(communes)), key=lambda i: communes[i][2])
+    insee_idx = b"".join(U32.pack(i) for i in insee_order)
+
+    tmp = f"{out_path}.{os.getpid()}.tmp"  # workers qui compilent en même temps : chacun son fichier
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(communes), len(name_keys), len(word_keys), len(strings)))
+        f.write(commune_recs)
+        f.write(insee_idx)
+        f.write(names)
+        f.write(words)
+        f.write(strings)
+    os.replace(tmp, out_path)
+    return len(communes)
+
+
+# ---------- Lecture (mmap) ----------
+class _Keys:
+    """Vue "séquence triée" sur un tableau de clés de l'index, pour la dichotomie."""
+
+    def __init__(self, index: "CommuneIndex", start: int, count: int):
+        self.index, self.start, self.count = index, start, count
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i: int):
+        off, length, commune = KEY.unpack_from(self.index.buf, self.start + i * KEY.size)
+        return self.index.string(off, length), commune
+
+    def lower_bound(self, prefix: str) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class CommuneIndex:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, n_names, n_words, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"index de communes invalide: {path}")
+        self.communes_at = HEADER.size
+        self.insee_at = self.communes_at + self.n * COMMUNE.size
+        names_at = self.insee_at + self.n * U32.size
+        words_at = names_at + n_names * KEY.size
+        self.strings_at = words_at + n_words * KEY.size
+        self.names = _Keys(self, names_at, n_names)
+        self.words = _Keys(self, words_at, n_words)
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def string(self, off: int, length: int) -> str:
+        start = self.strings_at + off
+        return self.buf[start:start + length].decode("utf-8")
+
+    def commune(self, i: int) -> Dict[str, str]:
+        insee, cp, off, length, _ = COMMUNE.unpack_from(self.buf, self.communes_at + i * COMMUNE.size)
+        name = self.string(off, length)
+        cp = cp.decode("ascii")
+        return {"id": insee.decode("ascii"), "name": name, "postcode": cp, "label": f"{name} ({cp})"}
+
+    def _postcode(self, i: int) -> str:
+        return self.buf[self.communes_at + i * COMMUNE.size + 5:self.communes_at + i * COMMUNE.size + 10].decode("ascii")
+
+    def _insee(self, j: int) -> str:
+        (i,) = U32.unpack_from(self.buf, self.insee_at + j * U32.size)
+        return self.buf[self.communes_at + i * COMMUNE.size:self.communes_at + i * COMMUNE.size + 5].decode("ascii")
+
+    # ---------- Recherche ----------
+    def search(self, q: str, limit: int = GEO_MAX_RESULTS) -> List[Dict[str, str]]:
+        key = normalize(q)
+        if not key:
+            return []
+        found: List[int] = []
+        if key.replace(" ", "").isdigit():
+            prefix = key.replace(" ", "")
+            lo, hi = 0, self.n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._postcode(mid) < prefix:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < self.n and len(found) < limit and self._postcode(lo).startswith(prefix):
+                found.append(lo)
+                lo += 1
+        else:
+            # meilleur rang par code INSEE (une commune à plusieurs codes postaux = une entrée)
+            best: Dict[bytes, tuple] = {}
+            for tier, keys in enumerate((self.names, self.words)):
+                if len(best) >= limit:
+                    break  # les mots intérieurs viennent après les noms complets
+                i = keys.lower_bound(key)
+                end = min(len(keys), i + GEO_SCAN_MAX)
+                while i < end:
+                    k, commune = keys.entry(i)
+                    if not k.startswith(key):
+                        break
+                    insee, _, _, _, weight = COMMUNE.unpack_from(self.buf, self.communes_at + commune * COMMUNE.size)
+                    rank = (tier, k != key, -weight, _natural(k), commune)
+                    if insee not in best or rank < best[insee]:
+                        best[insee] = rank
+                    i += 1
+            found = [rank[-1] for rank in sorted(best.values())[:limit]]
+        return [self.commune(i) for i in found]
+
+    def by_id(self, insee: str) -> List[Dict[str, str]]:
+        """Toutes les entrées (une par code postal) d'un code INSEE."""
+        insee = (insee or "").strip().upper()
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._insee(mid) < insee:
+                lo = mid + 1
+            else:
+                hi = mid
+        out = []
+        while lo < self.n and self._insee(lo) == insee:
+            (i,) = U32.unpack_from(self.buf, self.insee_at + lo * U32.size)
+            out.append(self.commune(i))
+            lo += 1
+        return out
+
+    def resolve(self, text: str) -> Optional[str]:
+        """Code INSEE d'une saisie libre ("Toulouse", "31600") si elle est sans ambiguïté."""
+        key = normalize(text)
+        if not key:
+            return None
+        if len(key) == 5 and key.isdigit():
+            ids = {c["id"] for c in self.search(key, limit=50) if c["postcode"] == key}
+            if len(ids) > 1:
+                ids -= set(_ARRONDISSEMENTS)  # code postal d'arrondissement : l'arrondissement, pas la ville
+        else:
+            ids = {c["id"] for c in self.search(key, limit=50) if normalize(c["name"]) == key}
+        return ids.pop() if len(ids) == 1 else None
+
+
+_index: Optional[CommuneIndex] = None
+_index_lock = threading.Lock()
+
+
+def _index_is_stale() -> bool:
+    """Index absent, plus ancien que la source ou d'un format antérieur (MAGIC)."""
+    if not os.path.exists(GEO_SOURCE_PATH):
+        return False
+    if not os.path.exists(GEO_INDEX_PATH) or os.path.getmtime(GEO_INDEX_PATH) < os.path.getmtime(GEO_SOURCE_PATH):
+        return True
+    with open(GEO_INDEX_PATH, "rb") as f:
+        return f.read(len(MAGIC)) != MAGIC
+
+
+def get_index() -> Optional[CommuneIndex]:
+    """Index chargé une fois par process (compilé depuis la source si besoin) ; None sans données."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if _index_is_stale():
+                    n = build_index(GEO_SOURCE_PATH, GEO_INDEX_PATH)
+                    log.info("index des communes compilé depuis %s: %d entrées", GEO_SOURCE_PATH, n)
+                if os.path.exists(GEO_INDEX_PATH):
+                    _index = CommuneIndex(GEO_INDEX_PATH)
+                    log.info("index des communes chargé: %d entrées", _index.n)
+    return _index
+
+
+def canonical_commune_id(commune: str, commune_id: Optional[str] = None) -> Optional[str]:
+    """
+    Code INSEE à stocker : celui choisi dans l'autocomplétion (vérifié), sinon déduit de la
+    saisie libre quand elle est sans ambiguïté. Lève ValueError pour un code inconnu.
+    """
+    index = get_index()
+    if index is None:
+        return None
+    if commune_id:
+        if not index.by_id(commune_id):
+            raise ValueError("commune inconnue")
+        return commune_id.strip().upper()
+    return index.resolve(commune)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index des communes Coop'Bat")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="compile le CSV La Poste en index binaire")
+    b.add_argument("csv")
+    b.add_argument("--out", default=GEO_INDEX_PATH)
+    s = sub.add_parser("search")
+    s.add_argument("q")
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        print(f"{build_index(args.csv, args.out)} communes -> {args.out}")
+    elif get_index() is None:
+        parser.error(f"index absent: {GEO_INDEX_PATH} (lancer d'abord `python geo.py build`)")
+    else:
+        for c in get_index().search(args.q):
+            print(c["id"], c["label"])
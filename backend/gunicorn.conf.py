@@ -0,0 +1,35 @@
+"""
+Déploiement multi-workers (depuis backend/) :
+    gunicorn -c gunicorn.conf.py main:app
+
+preload_app : main est importé une seule fois dans le master (FastAPI, SQLAlchemy, modèles),
+la migration et les chargements lourds (index des communes, règles de métré, bcrypt) y sont
+faits avant le fork ; les workers en héritent (copy-on-write) et démarrent à chaud.
+Le démarrage de chaque worker est visible sur GET /ready (cold_start_ms).
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+
+
+def on_starting(server):
+    # master, app déjà préchargée : migration une fois pour tous les workers
+    import main
+    from database import engine, migrate
+
+    migrate()
+    main.warm_up()
+    engine.dispose()  # aucune connexion ouverte ne doit passer le fork
+
+
+def post_fork(server, worker):
+    from database import engine, replica_engines
+
+    # par sécurité : un pool hérité n'est jamais réutilisé dans le worker
+    engine.dispose(close=False)
+    for eng in replica_engines:
+        eng.dispose(close=False)
@@ -0,0 +1,483 @@
+"""
+File de travaux persistante (table `jobs`) pour tout ce qui suit la création d'une demande :
+archive JSON du lead, notification des artisans, pré-chiffrage (métré)...
+
+`create_request` se contente d'appeler `enqueue()` dans la même transaction que la demande,
+puis répond tout de suite. Les workers réclament les jobs, les exécutent et les relancent
+avec un backoff exponentiel en cas d'erreur.
+
+Un job en cours garde son verrou tant que son worker est vivant : le bail (locked_until)
+est prolongé toutes les JOB_VISIBILITY_TIMEOUT_S / 3 pendant l'exécution. Seul le job
+d'un worker mort est repris après JOB_VISIBILITY_TIMEOUT_S. Les jobs terminés sont
+purgés après JOB_DONE_RETENTION_H (job `purge_jobs`).
+
+Lancer des workers (depuis backend/) :
+    python jobs.py --workers 2
+    python jobs.py --once          # vide la file puis s'arrête
+"""
+import os
+import json
+import socket
+import logging
+import argparse
+import threading
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import delete, func, update, or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import WorkerSession, Job, WorkRequest, engine, worker_engine, replica_engines, migrate
+import notifications
+import retention
+import analytics
+import dedup
+import takeoff
+
+log = logging.getLogger("coopbat.jobs")
+
+JOB_VISIBILITY_TIMEOUT_S = int(os.getenv("JOB_VISIBILITY_TIMEOUT_S", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_S = float(os.getenv("JOB_RETRY_BASE_S", "5"))
+JOB_POLL_INTERVAL_S = float(os.getenv("JOB_POLL_INTERVAL_S", "1"))
+JOB_DONE_RETENTION_H = int(os.getenv("JOB_DONE_RETENTION_H", "168"))
+JOB_PURGE_INTERVAL_S = int(os.getenv("JOB_PURGE_INTERVAL_S", "3600"))
+
+ARCHIVES_DIR = os.getenv(
+    "ARCHIVES_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives"),
+)
+
+HANDLERS: Dict[str, Callable[[Session, dict], None]] = {}
+
+
+def handler(kind: str):
+    """Enregistre une fonction `fn(db, payload)` pour un type de job."""
+    def deco(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+# ---------- Producteur ----------
+def enqueue(db: Session, kind: str, payload: dict, delay_s: float = 0, max_attempts: Optional[int] = None) -> Job:
+    """
+    Ajoute un job à la session sans commit : il part avec la transaction de l'appelant
+    (pas de job orphelin si la demande est annulée, pas de demande sans job).
+    """
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status="pending",
+        attempts=0,
+        max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+        run_after=datetime.utcnow() + timedelta(seconds=delay_s),
+    )
+    db.add(job)
+    return job
+
+
+# ---------- Consommateur ----------
+def _claimable(now: datetime):
+    return or_(
+        and_(Job.status == "pending", Job.run_after <= now),
+        and_(Job.status == "running", Job.locked_until < now),
+    )
+
+
+def claim_next(db: Session, worker_id: str) -> Optional[Job]:
+    """
+    Réclame un job disponible. L'UPDATE conditionnel fait office de verrou :
+    si un autre worker l'a pris entre-temps, rowcount vaut 0 et on passe au suivant.
+    """
+    now = datetime.utcnow()
+    candidates = (
+        db.query(Job.id)
+        .filter(_claimable(now))
+        .order_by(Job.run_after, Job.id)
+        .limit(10)
+        .all()
+    )
+    for (job_id,) in candidates:
+        res = db.execute(
+            update(Job)
+            .where(Job.id == job_id, _claimable(now))
+            .values(
+                status="running",
+                locked_by=worker_id,
+                locked_until=now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT_S),
+                attempts=Job.attempts + 1,
+                started_at=now,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        if res.rowcount == 1:
+            return db.get(Job, job_id)
+    return None
+
+
+def _finish(db: Session, job_id: int, worker_id: str, **values) -> bool:
+    # ne touche au job que si on en est toujours propriétaire (sinon timeout + repris ailleurs)
+    res = db.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == "running", Job.locked_by == worker_id)
+        .values(locked_until=None, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return res.rowcount == 1
+
+
+class _Lease:
+    """Prolonge locked_until tant que le handler tourne (rétention, export, envoi SMTP...)."""
+
+    def __init__(self, job_id: int, worker_id: str):
+        self.job_id, self.worker_id = job_id, worker_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"job-lease-{job_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(JOB_VISIBILITY_TIMEOUT_S / 3):
+            db = WorkerSession()
+            try:
+                db.execute(
+                    update(Job)
+                    .where(Job.id == self.job_id, Job.status == "running", Job.locked_by == self.worker_id)
+                    .values(locked_until=datetime.utcnow() + timedelta(seconds=JOB_VISIBILITY_TIMEOUT_S))
+                    .execution_options(synchronize_session=False)
+                )
+                db.commit()
+            except Exception:
+                # base verrouillée par le handler lui-même... on retentera au prochain tour
+                db.rollback()
+                log.warning("job %s: prolongation du bail impossible", self.job_id, exc_info=True)
+            finally:
+                db.close()
+
+
+def run_job(db: Session, job: Job, worker_id: str) -> str:
+    job_id, kind, attempts, max_attempts = job.id, job.kind, job.attempts, job.max_attempts
+
+    if attempts > max_attempts:
+        _finish(db, job_id, worker_id, status="failed", finished_at=datetime.utcnow(),
+                last_error="visibility timeout dépassé trop de fois")
+        return "failed"
+
+    fn = HANDLERS.get(kind)
+    try:
+        if fn is None:
+            raise RuntimeError(f"aucun handler pour '{kind}'")
+        with _Lease(job_id, worker_id):
+            fn(db, json.loads(job.payload or "{}"))
+            db.commit()
+    except Exception:
+        db.rollback()
+        err = traceback.format_exc()
+        log.warning("job %s (%s) tentative %s/%s en erreur", job_id, kind, attempts, max_attempts)
+        if attempts >= max_attempts:
+            _finish(db, job_id, worker_id, status="failed", finished_at=datetime.utcnow(), last_error=err)
+            return "failed"
+        retry_at = datetime.utcnow() + timedelta(seconds=JOB_RETRY_BASE_S * 2 ** (attempts - 1))
+        try:
+            _finish(db, job_id, worker_id, status="pending", run_after=retry_at, last_error=err)
+        except IntegrityError:
+            # job coalescé : un autre du même type attend déjà (uq_jobs_pending_kind), il fera la relance
+            db.rollback()
+            _finish(db, job_id, worker_id, status="failed", finished_at=datetime.utcnow(), last_error=err)
+            return "failed"
+        return "retry"
+
+    _finish(db, job_id, worker_id, status="done", finished_at=datetime.utcnow(), last_error="")
+    return "done"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def work(worker_id: Optional[str] = None, stop: Optional[threading.Event] = None, once: bool = False) -> int:
+    """
+    Boucle d'un worker. `once=True` : s'arrête dès que la file est vide.
+    Retourne le nombre de jobs traités.
+    """
+    worker_id = worker_id or default_worker_id()
+    stop = stop or threading.Event()
+    processed = 0
+    while not stop.is_set():
+        db = WorkerSession()
+        try:
+            job = claim_next(db, worker_id)
+            if job is not None:
+                run_job(db, job, worker_id)
+                processed += 1
+                continue
+        except Exception:
+            log.exception("worker %s: erreur inattendue", worker_id)
+        finally:
+            db.close()
+        if once:
+            break
+        stop.wait(JOB_POLL_INTERVAL_S)
+    return processed
+
+
+def work_process():
+    """Cible des workers multiprocessing : le pool hérité du parent (migrate) n'est pas réutilisé."""
+    engine.dispose(close=False)
+    worker_engine.dispose(close=False)
+    for eng in replica_engines:
+        eng.dispose(close=False)
+    work()
+
+
+def start_worker_threads(n: int) -> threading.Event:
+    """Workers dans le process de l'API (petits déploiements). Retourne l'event d'arrêt."""
+    stop = threading.Event()
+    for i in range(n):
+        t = threading.Thread(target=work, kwargs={"stop": stop}, name=f"job-worker-{i}", daemon=True)
+        t.start()
+    return stop
+
+
+# ---------- Monitoring ----------
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return round(values[k], 3)
+
+
+def queue_stats(db: Session, sample: int = 500) -> dict:
+    now = datetime.utcnow()
+    depth = {status: 0 for status in ("pending", "running", "done", "failed")}
+    depth.update(db.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+
+    oldest = (
+        db.query(Job.created_at)
+        .filter(Job.status == "pending")
+        .order_by(Job.created_at)
+        .first()
+    )
+
+    recent = (
+        db.query(Job.created_at, Job.started_at, Job.finished_at)
+        .filter(Job.status == "done")
+        .order_by(Job.finished_at.desc())
+        .limit(sample)
+        .all()
+    )
+    wait_s = [(s - c).total_seconds() for c, s, f in recent if c and s]
+    total_s = [(f - c).total_seconds() for c, s, f in recent if c and f]
+
+    return {
+        "depth": depth,
+        "oldest_pending_age_s": round((now - oldest[0]).total_seconds(), 3) if oldest else 0,
+        "latency": {
+            "sample": len(total_s),
+            "wait_p50_s": _percentile(wait_s, 50),
+            "wait_p95_s": _percentile(wait_s, 95),
+            "total_p50_s": _percentile(total_s, 50),
+            "total_p95_s": _percentile(total_s, 95),
+        },
+    }
+
+
+# ---------- Handlers ----------
+def _write_json_atomic(path: str, data: dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _surface_or_none(value: str) -> Optional[float]:
+    try:
+        return float((value or "").replace(",", ".").strip())
+    except ValueError:
+        return None
+
+
+ZINGUERIE_FIELDS = ("gouttiere_ml", "habillage_rives_ml", "habillage_mur_m2", "couverture_zinc_m2", "tour_cheminee_nb")
+
+
+def lead_payload(req: WorkRequest) -> dict:
+    """
+    Mêmes clés que les archives lead_*.json existantes (formulaire /lead), complétées
+    par les champs propres à POST /requests : quantités de zinguerie, lot, surface, budget.
+    user_id et couverture_ecran ne sont pas saisis sur ce formulaire (None).
+    """
+    zinguerie = {f: getattr(req, f) for f in ZINGUERIE_FIELDS if (getattr(req, f) or "").strip()}
+    return {
+        "user_id": None,
+        "couverture_type": req.cover_type or "",
+        "couverture_surface_m2": _surface_or_none(req.cover_surface_m2),
+        "couverture_isolation": bool(req.insulation),
+        "couverture_sarking": bool(req.sarking),
+        "couverture_ecran": None,
+        "zinguerie_choices": list(zinguerie),
+        "charpente_choices": [x for x in (req.charp_options or "").split(";") if x],
+        "contact_name": req.name,
+        "contact_commune": req.commune,
+        "contact_email": req.email,
+        "contact_message": req.message or "",
+        # champs supplémentaires (absents des archives du formulaire /lead)
+        "zinguerie_quantities": zinguerie,
+        "lot_type": req.lot_type or "",
+        "surface_m2": req.surface_m2 or "",
+        "budget": req.budget or "",
+    }
+
+
+def _archive_once(kind: str, req: WorkRequest, payload: dict):
+    # idempotent : une relance après un crash ne duplique pas l'archive
+    prefix = f"{kind}_{req.id}_"
+    if os.path.isdir(ARCHIVES_DIR) and any(
+        n.startswith(prefix) and n.endswith(".json") for n in os.listdir(ARCHIVES_DIR)
+    ):
+        return
+
+    created = req.created_at or datetime.utcnow()
+    _write_json_atomic(
+        os.path.join(ARCHIVES_DIR, f"{prefix}{created.strftime('%Y%m%d_%H%M%S')}.json"),
+        {"type": kind, "id": req.id, "created_at": created.isoformat(), "payload": payload},
+    )
+
+
+@handler("archive_lead")
+def archive_lead(db: Session, payload: dict):
+    req = db.get(WorkRequest, int(payload["request_id"]))
+    if req is None:
+        return  # demande supprimée entre-temps
+    _archive_once("lead", req, lead_payload(req))
+
+
+@handler("precompute_quote")
+def precompute_quote(db: Session, payload: dict):
+    req = db.get(WorkRequest, int(payload["request_id"]))
+    if req is None:
+        return
+    _archive_once("quote", req, takeoff.takeoff_for_request(req))
+
+
+def ensure_pending(db: Session, kind: str, delay_s: float = 0) -> Job:
+    """
+    Enqueue `kind` sauf si un job identique attend déjà (coalescence). Deux process qui
+    vérifient en même temps (démarrage de plusieurs workers) sont départagés par l'index
+    unique uq_jobs_pending_kind : l'insert perdant est annulé dans son savepoint.
+    """
+    pending = db.query(Job).filter(Job.kind == kind, Job.status == "pending")
+    job = pending.first()
+    if job is not None:
+        return job
+    try:
+        with db.begin_nested():
+            job = enqueue(db, kind, {}, delay_s=delay_s)
+        return job
+    except IntegrityError:
+        return pending.first()
+
+
+@handler("notify_artisans")
+def notify_artisans(db: Session, payload: dict):
+    req = db.get(WorkRequest, int(payload["request_id"]))
+    if req is None:
+        return
+    n = notifications.queue_for_request(db, req)
+    log.info("demande %s (%s): %d artisan(s) à notifier", req.id, req.commune, n)
+    if n:
+        # un seul envoi groupé par fenêtre, quel que soit le nombre de demandes
+        ensure_pending(db, "send_digests", delay_s=notifications.NOTIFY_DIGEST_WINDOW_S)
+
+
+@handler("send_digests")
+def send_digests(db: Session, payload: dict):
+    notifications.send_pending_digests(db)
+
+
+@handler("retention")
+def run_retention(db: Session, payload: dict):
+    retention.run_retention(db)
+    if retention.RETENTION_ENABLED:
+        ensure_pending(db, "retention", delay_s=retention.RETENTION_INTERVAL_S)
+
+
+@handler("analytics_export")
+def analytics_export(db: Session, payload: dict):
+    try:
+        analytics.run_export(db, payload.get("tables"), full=bool(payload.get("full")))
+    except analytics.ExportBusy:
+        log.info("analytics_export: un export est déjà en cours, ignoré")
+    if analytics.EXPORT_ENABLED:
+        ensure_pending(db, "analytics_export", delay_s=analytics.EXPORT_INTERVAL_S)
+
+
+@handler("purge_jobs")
+def purge_jobs(db: Session, payload: dict):
+    """Supprime les jobs terminés anciens : la table (et queue_stats) reste petite."""
+    cutoff = datetime.utcnow() - timedelta(hours=JOB_DONE_RETENTION_H)
+    res = db.execute(
+        delete(Job)
+        .where(Job.status == "done", Job.finished_at < cutoff)
+        .execution_options(synchronize_session=False)
+    )
+    log.info("purge_jobs: %d job(s) terminé(s) supprimé(s)", res.rowcount)
+    ensure_pending(db, "purge_jobs", delay_s=JOB_PURGE_INTERVAL_S)
+
+
+@handler("dedup_lead")
+def dedup_lead(db: Session, payload: dict):
+    """Premier job d'une demande : contrôle des messages proches, puis la suite habituelle."""
+    req = db.get(WorkRequest, int(payload["request_id"]))
+    if req is None:
+        return
+    if dedup.check_similar(db, req):
+        # doublon : archivé, mais ni notifié ni chiffré
+        enqueue(db, "archive_lead", {"request_id": req.id})
+    else:
+        enqueue_post_submission(db, req.id)
+
+
+def enqueue_post_submission(db: Session, request_id: int):
+    """Tout ce qui suit POST /requests (via `dedup_lead`)."""
+    enqueue(db, "archive_lead", {"request_id": request_id})
+    enqueue(db, "notify_artisans", {"request_id": request_id})
+    enqueue(db, "precompute_quote", {"request_id": request_id})
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description="Workers de la file de jobs Coop'Bat")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--once", action="store_true", help="vide la file puis s'arrête")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(message)s")
+    migrate()
+
+    if args.once or args.workers <= 1:
+        n = work(once=args.once)
+        print(f"{n} job(s) traité(s)")
+    else:
+        procs = [multiprocessing.Process(target=work_process, name=f"job-worker-{i}") for i in range(args.workers)]
+        for p in procs:
+            p.start()
+        try:
+            for p in procs:
+                p.join()
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
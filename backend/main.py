@@ -1,17 +1,105 @@
 import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, List
+from typing import Dict, Optional, List, Union
 
-from fastapi import FastAPI, Depends, HTTPException, Header
+from fastapi import FastAPI, Depends, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from pydantic import BaseModel, ConfigDict, EmailStr
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
-from passlib.context import CryptContext
+from database import SessionLocal, migrate, ProUser, ArtisanUser, WorkRequest, RequestAssignment
+import jobs
+import retention
+import profiling
+import takeoff
+import devis
+import dedup
+import analytics
+import geo
+from sqlite_writer import SQLITE_SINGLE_WRITER, run_write
+
+log = logging.getLogger("coopbat.api")
+IMPORTED_IN_PID = os.getpid()  # != pid du worker quand l'app est préchargée (gunicorn preload_app)
+
+
+# ---------- Cycle de vie ----------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    t0 = time.perf_counter()
+    if JOBS_INPROCESS_WORKERS > 0 and SQLITE_SINGLE_WRITER:
+        # les handlers écrivent hors du writer unique : ils se disputeraient le verrou avec l'API
+        raise RuntimeError("JOBS_INPROCESS_WORKERS incompatible avec le writer SQLite unique : lancer `python jobs.py`")
+    # migration gardée par un verrou inter-process : un worker migre, les autres constatent
+    migrated = await run_in_threadpool(migrate)
+    await run_in_threadpool(_schedule_periodic_jobs)
+    if JOBS_INPROCESS_WORKERS > 0:
+        app.state.jobs_stop = jobs.start_worker_threads(JOBS_INPROCESS_WORKERS)
+    # index des communes, règles de métré, passlib : chargés à côté, le worker est prêt sans eux
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+    age = profiling.process_age_s()
+    app.state.startup = {
+        "pid": os.getpid(),
+        "preloaded": os.getpid() != IMPORTED_IN_PID,
+        "migrated": migrated,
+        "startup_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "cold_start_ms": round(age * 1000, 1) if age is not None else None,  # lancement du process -> prêt
+        "ready_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+    log.info("worker %(pid)s prêt: démarrage %(startup_ms)s ms, à froid %(cold_start_ms)s ms", app.state.startup)
+    yield
+
+    stop = getattr(app.state, "jobs_stop", None)
+    if stop is not None:
+        stop.set()
+    devis.shutdown_pool()
+
+
+app = FastAPI(title="Coop'Bat API", lifespan=lifespan)
+app.router.route_class = profiling.TimedRoute
+
+
+# ---------- Taille des corps ----------
+class BodyLimitMiddleware:
+    """413 au-delà de `limits[path]` octets : Content-Length annoncé, ou corps envoyé par morceaux."""
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        too_large = f"corps de requête limité à {limit} octets"
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            return await JSONResponse({"detail": too_large}, status_code=413)(scope, receive, send)
 
-from database import SessionLocal, ProUser, ArtisanUser, WorkRequest, RequestAssignment
+        received = 0
 
-app = FastAPI(title="Coop'Bat API")
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                # relevée par FastAPI pendant la lecture du corps -> réponse 413
+                raise HTTPException(status_code=413, detail=too_large)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# ajouté avant CORS : la réponse 413 porte encore les en-têtes CORS
+app.add_middleware(BodyLimitMiddleware, limits={"/devis": devis.DEVIS_MAX_BODY_BYTES})
 
 # ---------- CORS ----------
 cors_origins = os.getenv("CORS_ORIGINS", "*")
@@ -25,12 +113,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_pwd_context = None
+
+
+def pwd_context():
+    """passlib/bcrypt importés au premier usage (ou par warm_up), pas au démarrage."""
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
 
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
+# Workers de jobs dans le process API (0 = workers lancés à part : python jobs.py).
+# Refusé en mode SQLite réglé (writer unique) : les workers tournent alors dans leur propre process.
+JOBS_INPROCESS_WORKERS = int(os.getenv("JOBS_INPROCESS_WORKERS", "0"))
+
 
 def get_db():
+    # primaire : un client relit toujours ce qu'il vient d'écrire
     db = SessionLocal()
     try:
         yield db
@@ -38,12 +140,75 @@ def get_db():
         db.close()
 
 
+def get_replica_db():
+    # listes et statistiques, tolérantes au retard de réplication (primaire si aucun réplica)
+    db = SessionLocal()
+    db.use_replica = True
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _schedule_periodic_jobs():
+    def write(s: Session):
+        jobs.ensure_pending(s, "purge_jobs")
+        if retention.RETENTION_ENABLED:
+            jobs.ensure_pending(s, "retention")
+        if analytics.EXPORT_ENABLED:
+            jobs.ensure_pending(s, "analytics_export")
+
+    db = SessionLocal()
+    try:
+        run_write(db, write)
+    finally:
+        db.close()
+
+
+def warm_up():
+    """Chargements lourds différés ; appelé en tâche de fond par chaque worker, ou une fois avant le fork."""
+    try:
+        geo.get_index()
+        takeoff.rules()
+        pwd_context().handler().get_backend()  # charge le backend bcrypt sans hacher
+    except Exception:
+        log.exception("warm-up incomplet (chargement au premier usage)")
+
+
+# ---------- Timing par requête (X-Timing: 1 + token admin) ----------
+def _admin_token_ok(token: Optional[str]) -> bool:
+    try:
+        require_admin(token)
+    except HTTPException:
+        return False
+    return True
+
+
+app.add_middleware(profiling.TimingMiddleware, authorize=_admin_token_ok)
+
+
 # ---------- Health ----------
 @app.get("/health")
 def health():
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
 
 
+@app.get("/ready")
+def ready():
+    """Prêt à recevoir du trafic : démarrage terminé (schéma migré) et base primaire joignable."""
+    startup = getattr(app.state, "startup", None)
+    if startup is None:
+        raise HTTPException(status_code=503, detail="Démarrage en cours")
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception:
+        raise HTTPException(status_code=503, detail="Base de données injoignable")
+    finally:
+        db.close()
+    return {"status": "ready", **startup}
+
+
 # ---------- Schemas ----------
 class ProRegisterIn(BaseModel):
     name: str
@@ -61,7 +226,10 @@ class ArtisanRegisterIn(BaseModel):
     email: EmailStr
     password: str
     commune: str
-    radius_km: int
+    commune_id: Optional[str] = None  # code INSEE choisi dans /geo/communes
+    # tout le département plutôt que la seule commune ; à défaut, radius_km > 0 (anciens clients)
+    whole_departement: Optional[bool] = None
+    radius_km: Optional[int] = None
     phone: Optional[str] = ""
     zone_note: Optional[str] = ""
 
@@ -72,6 +240,7 @@ class WorkRequestIn(BaseModel):
     email: EmailStr
     commune: str
     surface_m2: str
+    commune_id: Optional[str] = None  # code INSEE choisi dans /geo/communes
 
     # infos générales
     lot_type: str = "lot"  # lot/charpente/couverture/zinguerie
@@ -122,6 +291,10 @@ class WorkRequestOut(BaseModel):
 
     charp_options: str
 
+    duplicate_of: Optional[int] = None
+    possible_duplicate_of: Optional[int] = None
+    commune_id: Optional[str] = None
+
 
 def require_admin(x_admin_token: Optional[str]):
     if not ADMIN_TOKEN:
@@ -136,50 +309,84 @@ def register_pro(data: ProRegisterIn, db: Session = Depends(get_db)):
     if db.query(ProUser).filter(ProUser.email == data.email).first():
         raise HTTPException(status_code=400, detail="Email déjà utilisé")
 
-    user = ProUser(
-        name=data.name.strip(),
-        email=data.email,
-        password_hash=pwd_context.hash(data.password),
-    )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    return {"message": "ok", "user_id": user.id}
+    with profiling.timed("hashing"):
+        password_hash = pwd_context().hash(data.password)
+
+    def write(s: Session):
+        user = ProUser(name=data.name.strip(), email=data.email, password_hash=password_hash)
+        s.add(user)
+        s.flush()
+        return user.id
+
+    return {"message": "ok", "user_id": run_write(db, write)}
 
 
 @app.post("/login")
 def login_pro(data: LoginIn, db: Session = Depends(get_db)):
     user = db.query(ProUser).filter(ProUser.email == data.email).first()
-    if not user or not pwd_context.verify(data.password, user.password_hash):
+    with profiling.timed("hashing"):
+        ok = user is not None and pwd_context().verify(data.password, user.password_hash)
+    if not ok:
         raise HTTPException(status_code=401, detail="Identifiants invalides")
     return {"message": "ok", "user_id": user.id, "name": user.name, "email": user.email}
 
 
+# ---------- Communes ----------
+def _commune_id(commune: str, commune_id: Optional[str]) -> Optional[str]:
+    try:
+        return geo.canonical_commune_id(commune, commune_id)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Commune inconnue")
+
+
+@app.get("/geo/communes")
+def search_communes(q: str = "", limit: int = geo.GEO_MAX_RESULTS):
+    index = geo.get_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="Référentiel des communes non installé")
+    return index.search(q, limit=max(1, min(limit, geo.GEO_MAX_RESULTS)))
+
+
 # ---------- Auth Artisan ----------
 @app.post("/artisan/register")
 def register_artisan(data: ArtisanRegisterIn, db: Session = Depends(get_db)):
     if db.query(ArtisanUser).filter(ArtisanUser.email == data.email).first():
         raise HTTPException(status_code=400, detail="Email déjà utilisé")
 
-    artisan = ArtisanUser(
-        contact_name=data.contact_name.strip(),
-        email=data.email,
-        password_hash=pwd_context.hash(data.password),
-        commune=data.commune.strip(),
-        radius_km=int(data.radius_km),
-        phone=(data.phone or "").strip(),
-        zone_note=(data.zone_note or "").strip(),
-    )
-    db.add(artisan)
-    db.commit()
-    db.refresh(artisan)
-    return {"message": "ok", "artisan_id": artisan.id}
+    commune_id = _commune_id(data.commune, data.commune_id)
+    whole_departement = data.whole_departement
+    if whole_departement is None:
+        whole_departement = (data.radius_km or 0) > 0
+
+    with profiling.timed("hashing"):
+        password_hash = pwd_context().hash(data.password)
+
+    def write(s: Session):
+        artisan = ArtisanUser(
+            contact_name=data.contact_name.strip(),
+            email=data.email,
+            password_hash=password_hash,
+            commune=data.commune.strip(),
+            commune_id=commune_id,
+            radius_km=int(data.radius_km or 0),
+            whole_departement=whole_departement,
+            **geo.zone_keys(data.commune, commune_id),
+            phone=(data.phone or "").strip(),
+            zone_note=(data.zone_note or "").strip(),
+        )
+        s.add(artisan)
+        s.flush()
+        return artisan.id
+
+    return {"message": "ok", "artisan_id": run_write(db, write)}
 
 
 @app.post("/artisan/login")
 def login_artisan(data: LoginIn, db: Session = Depends(get_db)):
     artisan = db.query(ArtisanUser).filter(ArtisanUser.email == data.email).first()
-    if not artisan or not pwd_context.verify(data.password, artisan.password_hash):
+    with profiling.timed("hashing"):
+        ok = artisan is not None and pwd_context().verify(data.password, artisan.password_hash)
+    if not ok:
         raise HTTPException(status_code=401, detail="Identifiants invalides")
     return {
         "message": "ok",
@@ -196,70 +403,263 @@ def create_request(data: WorkRequestIn, db: Session = Depends(get_db)):
     if not data.name.strip() or not data.commune.strip() or not data.surface_m2.strip():
         raise HTTPException(status_code=422, detail="Nom, commune et m² obligatoires")
 
-    req = WorkRequest(
-        name=data.name.strip(),
-        email=data.email,
-        commune=data.commune.strip(),
-        surface_m2=data.surface_m2.strip(),
-        lot_type=(data.lot_type or "lot").strip(),
-        budget=(data.budget or "").strip(),
-        message=(data.message or "").strip(),
-
-        cover_type=(data.cover_type or "").strip(),
-        cover_surface_m2=(data.cover_surface_m2 or "").strip(),
-        insulation=bool(data.insulation),
-        sarking=bool(data.sarking),
-
-        gouttiere_ml=(data.gouttiere_ml or "").strip(),
-        habillage_rives_ml=(data.habillage_rives_ml or "").strip(),
-        habillage_mur_m2=(data.habillage_mur_m2 or "").strip(),
-        couverture_zinc_m2=(data.couverture_zinc_m2 or "").strip(),
-        tour_cheminee_nb=(data.tour_cheminee_nb or "").strip(),
-
-        charp_options=";".join([x.strip() for x in (data.charp_options or []) if x.strip()]),
-        status="nouvelle",
+    commune_id = _commune_id(data.commune, data.commune_id)
+    fields = data.model_dump()
+    # empreinte exacte seulement (les messages proches : job dedup_lead) ; lecture seule,
+    # hors du verrou d'écriture (deux doublons simultanés peuvent passer)
+    duplicate_of, fp = dedup.find_duplicate(db, fields)
+    if SQLITE_SINGLE_WRITER:
+        db.rollback()  # l'écriture part sur le thread writer : pas de lecture ouverte à côté
+    if duplicate_of is not None and dedup.DEDUP_MODE == "merge":
+        return {"message": "ok", "request_id": duplicate_of, "duplicate_of": duplicate_of}
+
+    def write(s: Session):
+        req = WorkRequest(
+            name=data.name.strip(),
+            email=data.email,
+            commune=data.commune.strip(),
+            commune_id=commune_id,
+            surface_m2=data.surface_m2.strip(),
+            lot_type=(data.lot_type or "lot").strip(),
+            budget=(data.budget or "").strip(),
+            message=(data.message or "").strip(),
+
+            cover_type=(data.cover_type or "").strip(),
+            cover_surface_m2=(data.cover_surface_m2 or "").strip(),
+            insulation=bool(data.insulation),
+            sarking=bool(data.sarking),
+
+            gouttiere_ml=(data.gouttiere_ml or "").strip(),
+            habillage_rives_ml=(data.habillage_rives_ml or "").strip(),
+            habillage_mur_m2=(data.habillage_mur_m2 or "").strip(),
+            couverture_zinc_m2=(data.couverture_zinc_m2 or "").strip(),
+            tour_cheminee_nb=(data.tour_cheminee_nb or "").strip(),
+
+            charp_options=";".join([x.strip() for x in (data.charp_options or []) if x.strip()]),
+            status="nouvelle",
+            duplicate_of=duplicate_of,
+            fingerprint=fp,
+        )
+        s.add(req)
+        s.flush()  # id dispo pour les jobs, même transaction
+        if duplicate_of is None:
+            jobs.enqueue(s, "dedup_lead", {"request_id": req.id})  # puis archive, notification, chiffrage
+        else:
+            # doublon signalé : archivé, mais ni notifié ni chiffré
+            jobs.enqueue(s, "archive_lead", {"request_id": req.id})
+        return req.id, duplicate_of
+
+    request_id, duplicate_of = run_write(db, write)
+    return {"message": "ok", "request_id": request_id, "duplicate_of": duplicate_of}
+
+
+def request_out(r) -> WorkRequestOut:
+    return WorkRequestOut(
+        id=r.id,
+        created_at=r.created_at.isoformat(),
+        status=r.status,
+
+        name=r.name,
+        email=r.email,
+        commune=r.commune,
+
+        lot_type=r.lot_type,
+        surface_m2=r.surface_m2,
+        budget=r.budget or "",
+        message=r.message or "",
+
+        cover_type=r.cover_type or "",
+        cover_surface_m2=r.cover_surface_m2 or "",
+        insulation=bool(r.insulation),
+        sarking=bool(r.sarking),
+
+        gouttiere_ml=r.gouttiere_ml or "",
+        habillage_rives_ml=r.habillage_rives_ml or "",
+        habillage_mur_m2=r.habillage_mur_m2 or "",
+        couverture_zinc_m2=r.couverture_zinc_m2 or "",
+        tour_cheminee_nb=r.tour_cheminee_nb or "",
+
+        charp_options=r.charp_options or "",
+
+        duplicate_of=getattr(r, "duplicate_of", None),  # absent des archives antérieures
+        possible_duplicate_of=getattr(r, "possible_duplicate_of", None),
+        commune_id=getattr(r, "commune_id", None),
     )
-    db.add(req)
-    db.commit()
-    db.refresh(req)
-    return {"message": "ok", "request_id": req.id}
+
+
+# colonnes de WorkRequestOut seulement : des lignes plutôt que des objets ORM suivis par la session
+_OUT_COLUMNS = [getattr(WorkRequest, f) for f in WorkRequestOut.model_fields]
+_OUT_STR_FIELDS = [f for f, info in WorkRequestOut.model_fields.items() if info.annotation is str]
+
+
+def request_out_dict(row) -> dict:
+    """Comme request_out, en dict : response_model valide une seule fois (liste complète)."""
+    d = row._asdict()
+    for f in _OUT_STR_FIELDS:
+        if d[f] is None:
+            d[f] = ""
+    d["created_at"] = row.created_at.isoformat()
+    d["insulation"], d["sarking"] = bool(row.insulation), bool(row.sarking)
+    return d
 
 
 @app.get("/requests", response_model=list[WorkRequestOut])
-def list_requests(db: Session = Depends(get_db)):
-    items = db.query(WorkRequest).order_by(WorkRequest.created_at.desc()).all()
-    out = []
-    for r in items:
-        out.append(
-            WorkRequestOut(
-                id=r.id,
-                created_at=r.created_at.isoformat(),
-                status=r.status,
-
-                name=r.name,
-                email=r.email,
-                commune=r.commune,
-
-                lot_type=r.lot_type,
-                surface_m2=r.surface_m2,
-                budget=r.budget or "",
-                message=r.message or "",
-
-                cover_type=r.cover_type or "",
-                cover_surface_m2=r.cover_surface_m2 or "",
-                insulation=bool(r.insulation),
-                sarking=bool(r.sarking),
-
-                gouttiere_ml=r.gouttiere_ml or "",
-                habillage_rives_ml=r.habillage_rives_ml or "",
-                habillage_mur_m2=r.habillage_mur_m2 or "",
-                couverture_zinc_m2=r.couverture_zinc_m2 or "",
-                tour_cheminee_nb=r.tour_cheminee_nb or "",
-
-                charp_options=r.charp_options or "",
-            )
-        )
-    return out
+def list_requests(include_duplicates: bool = False, db: Session = Depends(get_replica_db)):
+    q = db.query(*_OUT_COLUMNS)
+    if not include_duplicates:
+        q = q.filter(WorkRequest.duplicate_of.is_(None))
+    items = q.order_by(WorkRequest.created_at.desc()).all()
+    return [request_out_dict(r) for r in items]
+
+
+@app.get("/requests/{request_id}", response_model=WorkRequestOut)
+def get_request(request_id: int, db: Session = Depends(get_db)):
+    # table chaude puis archives de rétention
+    r = retention.get_request(db, request_id)
+    if r is None:
+        raise HTTPException(status_code=404, detail="Demande introuvable")
+    return request_out(r)
+
+
+# ---------- Métré ----------
+class TakeoffIn(BaseModel):
+    cover_type: Optional[str] = ""
+    cover_surface_m2: Optional[str] = ""
+    insulation: bool = False
+    sarking: bool = False
+    ecran: bool = True
+
+    gouttiere_ml: Optional[str] = ""
+    habillage_rives_ml: Optional[str] = ""
+    habillage_mur_m2: Optional[str] = ""
+    couverture_zinc_m2: Optional[str] = ""
+    tour_cheminee_nb: Optional[str] = ""
+
+    charp_options: List[str] = []
+    charp_surface_m2: Optional[str] = ""
+
+
+@app.post("/takeoff")
+def compute_takeoff(data: TakeoffIn):
+    return takeoff.takeoff(**data.model_dump())
+
+
+@app.get("/requests/{request_id}/takeoff")
+def request_takeoff(request_id: int, db: Session = Depends(get_db)):
+    r = retention.get_request(db, request_id)
+    if r is None:
+        raise HTTPException(status_code=404, detail="Demande introuvable")
+    return takeoff.takeoff_for_request(r)
+
+
+# ---------- Devis (HTML / PDF) ----------
+class DevisLine(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    category: Optional[str] = ""
+    item_id: Optional[int] = None
+    name: Optional[str] = ""
+    qty: Union[float, str, None] = None
+    unit: Optional[str] = ""
+
+
+class DevisSection(BaseModel):
+    """Section du format V2 : {"lines": [...]}."""
+    model_config = ConfigDict(extra="allow")
+
+    lines: List[DevisLine] = []
+
+
+class DevisPayload(BaseModel):
+    """Chiffrage avancé V2 (couverture_2.lines...) ou V2++ (couverture_lines...) ; champs en plus conservés."""
+    model_config = ConfigDict(extra="allow")
+
+    couverture_lines: Optional[List[DevisLine]] = None
+    zinguerie_lines: Optional[List[DevisLine]] = None
+    charpente_lines: Optional[List[DevisLine]] = None
+    couverture_2: Optional[DevisSection] = None
+    zinguerie_2: Optional[DevisSection] = None
+    charpente_2: Optional[DevisSection] = None
+    message: Optional[str] = ""
+    catalog_version: Optional[str] = None
+    payload: Optional["DevisPayload"] = None  # archive advanced_*.json complète
+
+
+class DevisIn(BaseModel):
+    artisan_id: int
+    contact_name: Optional[str] = ""
+    contact_email: Optional[str] = ""
+    contact_commune: Optional[str] = ""
+    date: Optional[str] = ""  # JJ/MM/AAAA ; date du jour si absente
+    payload: DevisPayload
+    format: str = "pdf"
+
+
+async def _render_devis(doc: dict, fmt: str) -> dict:
+    if fmt not in devis.FORMATS:
+        raise HTTPException(status_code=422, detail="format invalide (html/pdf)")
+    catalog = doc["payload"].get("catalog_version") or takeoff.catalog_version()
+    digest = await run_in_threadpool(devis.store_source, doc, catalog)
+    await asyncio.wrap_future(devis.ensure_rendered(doc, digest, fmt))
+    return {"hash": digest, "urls": {f: f"/devis/{digest}.{f}" for f in devis.FORMATS}}
+
+
+def _require_artisan(db: Session, artisan_id: int):
+    if db.get(ArtisanUser, artisan_id) is None:
+        raise HTTPException(status_code=404, detail="Artisan introuvable")
+
+
+@app.post("/devis")
+async def create_devis(data: DevisIn, db: Session = Depends(get_db)):
+    # réservé aux artisans, comme /artisan/requests/{id}/treat
+    await run_in_threadpool(_require_artisan, db, data.artisan_id)
+    # champs envoyés seulement : le document haché est celui du client
+    doc = data.model_dump(exclude_unset=True, exclude={"artisan_id"})
+    fmt = doc.pop("format", "pdf")
+    # la date fait partie du document haché : un même hash donne toujours les mêmes octets
+    doc["date"] = data.date or datetime.utcnow().strftime("%d/%m/%Y")
+    return await _render_devis(doc, fmt)
+
+
+@app.post("/requests/{request_id}/devis")
+async def create_request_devis(request_id: int, format: str = "pdf", db: Session = Depends(get_db)):
+    r = await run_in_threadpool(retention.get_request, db, request_id)
+    if r is None:
+        raise HTTPException(status_code=404, detail="Demande introuvable")
+    doc = {
+        "contact_name": r.name,
+        "contact_email": r.email,
+        "contact_commune": r.commune,
+        "date": r.created_at.strftime("%d/%m/%Y") if r.created_at else "",
+        "payload": dict(takeoff.takeoff_for_request(r), message=r.message or ""),
+    }
+    return await _render_devis(doc, format)
+
+
+@app.get("/devis/{digest}.{fmt}")
+async def get_devis(digest: str, fmt: str):
+    try:
+        path = devis.document_path(digest, fmt)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Devis introuvable")
+    if fmt not in devis.FORMATS:
+        raise HTTPException(status_code=404, detail="Devis introuvable")
+
+    if not devis.touch(path):
+        # rendu évincé ou autre format : on repart du payload stocké
+        doc = await run_in_threadpool(devis.load_source, digest)
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Devis introuvable")
+        await asyncio.wrap_future(devis.ensure_rendered(doc, digest, fmt))
+    devis.touch(devis.document_path(digest, "json"))  # le payload suit ses rendus dans l'ordre LRU
+
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}  # contenu adressé par hash
+    if devis.DEVIS_ACCEL_PREFIX:
+        headers["X-Accel-Redirect"] = f"{devis.DEVIS_ACCEL_PREFIX.rstrip('/')}/{digest[:2]}/{digest}.{fmt}"
+        return Response(media_type=devis.FORMATS[fmt], headers=headers)
+    # FileResponse : Range / If-Range / ETag, lecture par blocs depuis le disque
+    return FileResponse(path, media_type=devis.FORMATS[fmt], headers=headers,
+                        content_disposition_type="inline", filename=f"devis_{digest[:12]}.{fmt}")
 
 
 # ---------- Artisan: traiter une demande ----------
@@ -284,19 +684,75 @@ def artisan_treat_request(request_id: int, data: TreatIn, db: Session = Depends(
     if data.action != "treat":
         raise HTTPException(status_code=422, detail="action invalide (treat/later)")
 
-    # crée une assignation si pas déjà
-    existing = db.query(RequestAssignment).filter(
-        RequestAssignment.request_id == request_id,
-        RequestAssignment.artisan_id == data.artisan_id,
-    ).first()
+    def write(s: Session):
+        # crée une assignation si pas déjà
+        existing = s.query(RequestAssignment).filter(
+            RequestAssignment.request_id == request_id,
+            RequestAssignment.artisan_id == data.artisan_id,
+        ).first()
+
+        if not existing:
+            assign = RequestAssignment(request_id=request_id, artisan_id=data.artisan_id, status="en_traitement")
+            s.add(assign)
+
+        # statut global
+        r = s.get(WorkRequest, request_id)
+        r.status = "en_traitement"
+        return r.status
+
+    return {"message": "ok", "request_status": run_write(db, write)}
+
+
+# ---------- Admin: file de jobs ----------
+@app.get("/admin/jobs/stats")
+def admin_jobs_stats(x_admin_token: Optional[str] = Header(None), db: Session = Depends(get_replica_db)):
+    require_admin(x_admin_token)
+    return jobs.queue_stats(db)
+
+
+# ---------- Admin: export analytique (Parquet) ----------
+class ExportIn(BaseModel):
+    tables: List[str] = []
+    full: bool = False
 
-    if not existing:
-        assign = RequestAssignment(request_id=request_id, artisan_id=data.artisan_id, status="en_traitement")
-        db.add(assign)
 
-    # statut global
-    req.status = "en_traitement"
-    db.commit()
-    db.refresh(req)
+@app.post("/admin/exports")
+def admin_run_export(data: ExportIn, x_admin_token: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    require_admin(x_admin_token)
+    unknown = [t for t in data.tables if t not in analytics.TABLES]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"table(s) inconnue(s): {', '.join(unknown)}")
+    # l'export tourne dans un worker de la file de jobs, pas dans la requête
+    def write(s: Session):
+        job = jobs.enqueue(s, "analytics_export", {"tables": data.tables or None, "full": data.full})
+        s.flush()
+        return job.id
+
+    return {"message": "ok", "job_id": run_write(db, write)}
+
+
+@app.get("/admin/exports")
+def admin_export_state(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    return {"dir": analytics.EXPORT_DIR, "tables": analytics.load_state()}
+
+
+# ---------- Admin: profilage à chaud ----------
+@app.get("/admin/profile")
+def admin_profile(
+    seconds: float = 10,
+    interval_ms: float = profiling.PROFILE_DEFAULT_INTERVAL_MS,
+    x_admin_token: Optional[str] = Header(None),
+):
+    require_admin(x_admin_token)
+    if not 0 < seconds <= profiling.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=422, detail=f"seconds doit être entre 0 et {profiling.PROFILE_MAX_SECONDS}")
+
+    try:
+        with profiling.exclusive_profile():
+            folded = profiling.sample_stacks(seconds, interval_ms)
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="Profil déjà en cours")
 
-    return {"message": "ok", "request_status": req.status}
+    filename = f"profile_{os.getpid()}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.folded"
+    return PlainTextResponse(folded, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
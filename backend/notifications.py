@@ -0,0 +1,246 @@
+"""
+Notifications artisans : les nouvelles demandes sont regroupées en un digest par artisan
+sur une fenêtre configurable, puis envoyées sur des connexions SMTP persistantes.
+
+Les jobs `notify_artisans` / `send_digests` (jobs.py) appellent ce module.
+
+Test en local avec un serveur SMTP de debug (pip install aiosmtpd) :
+    python -m aiosmtpd -n -l 127.0.0.1:1025
+    SMTP_PORT=1025 python jobs.py
+"""
+import os
+import uuid
+import queue
+import smtplib
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import List, Optional
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import ArtisanUser, WorkRequest, Notification
+import geo
+
+log = logging.getLogger("coopbat.notifications")
+
+SMTP_HOST = os.getenv("SMTP_HOST", "127.0.0.1")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+SMTP_USER = os.getenv("SMTP_USER", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "0") == "1"
+SMTP_FROM = os.getenv("SMTP_FROM", "Coop'Bat <no-reply@coopbat.fr>")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_TIMEOUT_S = float(os.getenv("SMTP_TIMEOUT_S", "15"))
+
+# fenêtre de regroupement : un artisan reçoit au plus un mail par fenêtre
+NOTIFY_DIGEST_WINDOW_S = int(os.getenv("NOTIFY_DIGEST_WINDOW_S", "300"))
+# un digest "réclamé" mais jamais marqué envoyé (crash) redevient disponible après ce délai
+NOTIFY_CLAIM_TIMEOUT_S = int(os.getenv("NOTIFY_CLAIM_TIMEOUT_S", "120"))
+
+
+# ---------- Correspondance artisan / demande ----------
+def artisan_filter(req: WorkRequest):
+    """
+    Artisans concernés, en SQL (colonnes indexées) : même commune (code INSEE ou nom),
+    ou même département pour ceux qui couvrent tout leur département. None si la demande
+    n'a aucune clé exploitable.
+    """
+    zone = geo.zone_keys(req.commune, req.commune_id)
+    clauses = []
+    if req.commune_id:
+        clauses.append(ArtisanUser.commune_id == req.commune_id)
+    if zone["commune_key"]:
+        clauses.append(ArtisanUser.commune_key == zone["commune_key"])
+    if zone["departement"]:
+        clauses.append(and_(ArtisanUser.whole_departement.is_(True), ArtisanUser.departement == zone["departement"]))
+    return or_(*clauses) if clauses else None
+
+
+def queue_for_request(db: Session, req: WorkRequest, channel: str = "email") -> int:
+    """
+    Crée les lignes d'outbox pour les artisans concernés (sans commit).
+    Les artisans déjà notifiés pour cette demande sont ignorés.
+    """
+    match = artisan_filter(req)
+    if match is None:
+        return 0
+    already = select(Notification.artisan_id).where(Notification.request_id == req.id, Notification.channel == channel)
+    ids = [a for (a,) in db.query(ArtisanUser.id).filter(match, ArtisanUser.id.not_in(already)).all()]
+    for artisan_id in ids:
+        db.add(Notification(artisan_id=artisan_id, request_id=req.id, channel=channel))
+    return len(ids)
+
+
+# ---------- SMTP ----------
+class SmtpPool:
+    """
+    Petit pool de connexions SMTP persistantes (une session TCP/TLS réutilisée
+    pour tous les mails au lieu d'une connexion par message).
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASSWORD,
+                 starttls=SMTP_STARTTLS, size=SMTP_POOL_SIZE, timeout=SMTP_TIMEOUT_S):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> smtplib.SMTP:
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            conn.starttls()
+        if self.user:
+            conn.login(self.user, self.password)
+        return conn
+
+    def _acquire(self) -> smtplib.SMTP:
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def _release(self, conn: Optional[smtplib.SMTP]):
+        if conn is not None:
+            self._idle.put_nowait(conn)
+        self._slots.release()
+
+    def send(self, msg: EmailMessage):
+        conn = self._acquire()
+        try:
+            try:
+                conn.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # connexion fermée côté serveur pendant l'inactivité : on rouvre une fois
+                _quiet_close(conn)
+                conn = self._connect()
+                conn.send_message(msg)
+        except Exception:
+            _quiet_close(conn)
+            self._release(None)
+            raise
+        self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                _quiet_close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def _quiet_close(conn: smtplib.SMTP):
+    try:
+        conn.quit()
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool: Optional[SmtpPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> SmtpPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SmtpPool()
+        return _pool
+
+
+# ---------- Digests ----------
+def build_digest(artisan: ArtisanUser, requests: List[WorkRequest]) -> EmailMessage:
+    n = len(requests)
+    msg = EmailMessage()
+    msg["From"] = SMTP_FROM
+    msg["To"] = artisan.email
+    msg["Subject"] = f"Coop'Bat - {n} nouveau{'x' if n > 1 else ''} chantier{'s' if n > 1 else ''} près de chez vous"
+
+    lines = [f"Bonjour {artisan.contact_name},", "", "Nouvelles demandes dans votre zone :", ""]
+    for r in requests:
+        created = r.created_at.strftime("%d/%m/%Y %H:%M") if r.created_at else ""
+        lines.append(f"- #{r.id} {r.lot_type or 'lot'} à {r.commune}, {r.surface_m2} m² ({created})")
+    lines += ["", "Connectez-vous à votre espace artisan pour les traiter.", "", "L'équipe Coop'Bat"]
+    msg.set_content("\n".join(lines))
+    return msg
+
+
+def send_pending_digests(db: Session, pool: Optional[SmtpPool] = None) -> int:
+    """
+    Envoie un digest par artisan pour toutes les notifications non envoyées.
+    Les lignes sont d'abord réclamées (batch_id) pour qu'un autre worker ne les renvoie pas.
+    Retourne le nombre de mails envoyés.
+    """
+    pool = pool or get_pool()
+    now = datetime.utcnow()
+    batch_id = uuid.uuid4().hex
+
+    db.execute(
+        update(Notification)
+        .where(
+            Notification.sent_at.is_(None),
+            or_(
+                Notification.batch_id.is_(None),
+                Notification.claimed_at < now - timedelta(seconds=NOTIFY_CLAIM_TIMEOUT_S),
+            ),
+        )
+        .values(batch_id=batch_id, claimed_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+    rows = (
+        db.query(Notification, WorkRequest)
+        .join(WorkRequest, WorkRequest.id == Notification.request_id)
+        .filter(Notification.batch_id == batch_id)
+        .order_by(Notification.artisan_id, WorkRequest.created_at)
+        .all()
+    )
+    by_artisan = defaultdict(list)
+    for notif, req in rows:
+        by_artisan[notif.artisan_id].append((notif, req))
+
+    sent = 0
+    try:
+        for artisan_id, items in by_artisan.items():
+            artisan = db.get(ArtisanUser, artisan_id)
+            if artisan is None:
+                continue
+            pool.send(build_digest(artisan, [req for _, req in items]))
+            # commit par artisan : une erreur SMTP plus loin ne renverra pas ce digest
+            ids = [notif.id for notif, _ in items]
+            db.execute(
+                update(Notification)
+                .where(Notification.id.in_(ids))
+                .values(sent_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            sent += 1
+    except Exception:
+        # rend la main sur ce qui reste pour que la relance du job le reprenne
+        db.rollback()
+        db.execute(
+            update(Notification)
+            .where(Notification.batch_id == batch_id, Notification.sent_at.is_(None))
+            .values(batch_id=None, claimed_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        raise
+
+    log.info("digests envoyés: %d (%d notification(s))", sent, len(rows))
+    return sent
@@ -0,0 +1,233 @@
+"""
+Diagnostic à chaud d'un worker API, sans redémarrage.
+
+- `sample_stacks()` : profileur par échantillonnage (sys._current_frames toutes les
+  quelques ms) ; sortie au format "collapsed stacks" (flamegraph.pl, speedscope).
+  Exposé par GET /admin/profile?seconds=N.
+- Ventilation du temps par requête : avec `X-Timing: 1` + un X-ADMIN-TOKEN valide,
+  la réponse porte un en-tête `Server-Timing` (validation, db, hashing, handler,
+  serialization, total).
+
+Avec plusieurs workers uvicorn, seul le worker qui reçoit la requête est profilé.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_DEFAULT_INTERVAL_MS = float(os.getenv("PROFILE_DEFAULT_INTERVAL_MS", "5"))
+
+_profile_lock = threading.Lock()
+
+
+# ---------- Profileur par échantillonnage ----------
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(seconds: float, interval_ms: float = PROFILE_DEFAULT_INTERVAL_MS) -> str:
+    """
+    Échantillonne la pile de tous les threads (sauf le nôtre) pendant `seconds`.
+    Retourne une ligne "thread;frame;frame... N" par pile distincte.
+    """
+    me = threading.get_ident()
+    names = {}
+    counts: Counter = Counter()
+    interval = max(interval_ms, 0.5) / 1000.0
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if tid not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stack.append(names.get(tid, f"thread-{tid}").replace(" ", "_"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+
+@contextmanager
+def exclusive_profile():
+    """Un seul profil à la fois par process (sinon les échantillons se mélangent)."""
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("profil déjà en cours")
+    try:
+        yield
+    finally:
+        _profile_lock.release()
+
+
+# ---------- Démarrage ----------
+def process_age_s() -> Optional[float]:
+    """Âge du process courant (Linux, /proc), pour mesurer le démarrage à froid d'un worker."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # champ 22 : starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+# ---------- Ventilation par requête ----------
+_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("coop_timings", default=None)
+
+
+def start_timing() -> dict:
+    t = {"start": time.perf_counter(), "db": 0.0, "hashing": 0.0}
+    _timings.set(t)
+    return t
+
+
+@contextmanager
+def timed(bucket: str):
+    """Ajoute la durée du bloc au compteur `bucket` de la requête en cours (si chronométrée)."""
+    t = _timings.get()
+    if t is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t[bucket] = t.get(bucket, 0.0) + time.perf_counter() - t0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _timings.get() is not None:
+        conn.info.setdefault("coop_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    t = _timings.get()
+    starts = conn.info.get("coop_query_start")
+    if t is not None and starts:
+        t["db"] += time.perf_counter() - starts.pop()
+
+
+class TimedRoute(APIRoute):
+    """
+    Route qui note l'entrée/sortie de l'endpoint : avant = validation (corps + dépendances),
+    après = sérialisation de la réponse.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _mark_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            t = _timings.get()
+            if t is not None:
+                t["response_ready"] = time.perf_counter()
+            return response
+
+        return timed_handler
+
+
+def _mark_endpoint(endpoint: Callable) -> Callable:
+    def _enter(t):
+        t["endpoint_start"] = time.perf_counter()
+        t["db_at_endpoint_start"] = t["db"]
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            t = _timings.get()
+            if t is not None:
+                _enter(t)
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                if t is not None:
+                    t["endpoint_end"] = time.perf_counter()
+    else:
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            t = _timings.get()
+            if t is not None:
+                _enter(t)
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                if t is not None:
+                    t["endpoint_end"] = time.perf_counter()
+    return wrapper
+
+
+class TimingMiddleware:
+    """
+    Middleware ASGI pur : les requêtes sans `X-Timing: 1` (ou sans token admin valide)
+    passent tout droit, sans tâche ni copie du flux de réponse.
+    `authorize(token)` -> bool vérifie le token admin.
+    """
+
+    def __init__(self, app, authorize: Callable[[Optional[str]], bool]):
+        self.app = app
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timing = token = None
+        for name, value in scope["headers"]:
+            if name == b"x-timing":
+                timing = value
+            elif name == b"x-admin-token":
+                token = value.decode("latin-1")
+        if timing != b"1" or not self.authorize(token):
+            return await self.app(scope, receive, send)
+
+        t = start_timing()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(t).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+def server_timing(t: dict) -> str:
+    end = time.perf_counter()
+    start = t["start"]
+    ep_start = t.get("endpoint_start", end)
+    ep_end = t.get("endpoint_end", ep_start)
+    ready = t.get("response_ready", ep_end)
+    db_before = t.get("db_at_endpoint_start", 0.0)
+
+    parts = {
+        "validation": max(ep_start - start - db_before, 0.0),
+        "db": t["db"],
+        "hashing": t["hashing"],
+        "handler": max(ep_end - ep_start - (t["db"] - db_before) - t["hashing"], 0.0),
+        "serialization": max(ready - ep_end, 0.0),
+        "total": end - start,
+    }
+    return ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in parts.items())
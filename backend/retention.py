@@ -0,0 +1,343 @@
+"""
+Rétention des demandes : sort de `work_requests` (table chaude) les demandes anciennes
+ou dans un statut terminal, avec leurs assignations.
+
+- Postgres : tables partitionnées nativement par mois
+  (work_requests_archive / request_assignments_archive, une partition par mois).
+- SQLite : fichiers JSONL compressés par mois (archives/retention/work_requests_AAAA_MM.jsonl.gz),
+  un membre gzip par lot.
+
+La table `archived_requests` indexe id -> mois (+ position du membre gzip pour les fichiers),
+et `get_request()` retrouve une demande qu'elle soit chaude ou archivée en ne décompressant
+que son lot. Les demandes sans date de création restent dans la table chaude.
+Un cycle se termine par VACUUM/ANALYZE.
+
+Lancement manuel (depuis backend/) :
+    python retention.py [--dry-run]
+Planifié : RETENTION_ENABLED=1 (job `retention` relancé toutes les RETENTION_INTERVAL_S).
+"""
+import os
+import gzip
+import json
+import zlib
+import logging
+import argparse
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from sqlalchemy import text, and_, or_
+from sqlalchemy.orm import Session, undefer
+
+from database import engine, WorkRequest, RequestAssignment, Notification, ArchivedRequest, LeadBand
+
+log = logging.getLogger("coopbat.retention")
+
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0") == "1"
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "12"))
+RETENTION_TERMINAL_STATUSES = [
+    s.strip() for s in os.getenv("RETENTION_TERMINAL_STATUSES", "termine,annulee").split(",") if s.strip()
+]
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_INTERVAL_S = int(os.getenv("RETENTION_INTERVAL_S", str(24 * 3600)))
+RETENTION_DIR = os.getenv(
+    "RETENTION_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives", "retention"),
+)
+
+REQUEST_COLUMNS = [c.name for c in WorkRequest.__table__.columns]
+ASSIGNMENT_COLUMNS = [c.name for c in RequestAssignment.__table__.columns]
+
+
+def use_partitions() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def month_key(dt: datetime) -> str:
+    return f"{dt.year:04d}_{dt.month:02d}"
+
+
+def month_bounds(key: str):
+    year, month = int(key[:4]), int(key[5:7])
+    start = datetime(year, month, 1)
+    end = datetime(year + (month == 12), month % 12 + 1, 1)
+    return start, end
+
+
+def cutoff(now: Optional[datetime] = None, months: int = RETENTION_MONTHS) -> datetime:
+    now = now or datetime.utcnow()
+    total = now.year * 12 + (now.month - 1) - months
+    return datetime(total // 12, total % 12 + 1, 1)
+
+
+def _row(obj, columns) -> dict:
+    return {c: getattr(obj, c) for c in columns}
+
+
+def _jsonable(row: dict) -> dict:
+    return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in row.items()}
+
+
+def _from_json(row: dict) -> dict:
+    for k in ("created_at",):
+        if row.get(k):
+            row[k] = datetime.fromisoformat(row[k])
+    return row
+
+
+# ---------- Postgres : partitions mensuelles ----------
+def _add_missing_columns(conn, archive: str, table):
+    existing = {
+        r[0] for r in conn.execute(
+            text("SELECT column_name FROM information_schema.columns WHERE table_name = :t"), {"t": archive}
+        )
+    }
+    for col in table.columns:
+        if col.name not in existing:
+            conn.execute(text(f'ALTER TABLE {archive} ADD COLUMN "{col.name}" {col.type.compile(dialect=conn.dialect)}'))
+
+
+def ensure_partitions(conn, months: List[str]):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS work_requests_archive (LIKE work_requests INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (created_at)"
+    ))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS request_assignments_archive "
+        "(LIKE request_assignments INCLUDING DEFAULTS, request_created_at TIMESTAMP NOT NULL) "
+        "PARTITION BY RANGE (request_created_at)"
+    ))
+    # les colonnes ajoutées plus tard à la table chaude suivent dans l'archive
+    _add_missing_columns(conn, "work_requests_archive", WorkRequest.__table__)
+    _add_missing_columns(conn, "request_assignments_archive", RequestAssignment.__table__)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_work_requests_archive_id ON work_requests_archive (id)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_request_assignments_archive_request_id "
+        "ON request_assignments_archive (request_id)"
+    ))
+    for key in months:
+        start, end = month_bounds(key)
+        for parent in ("work_requests_archive", "request_assignments_archive"):
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {parent}_{key} PARTITION OF {parent} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            ))
+
+
+def _move_to_partitions(db: Session, ids: List[int], months: List[str]):
+    conn = db.connection()
+    ensure_partitions(conn, months)
+    req_cols = ", ".join(f'"{c}"' for c in REQUEST_COLUMNS)
+    asg_cols = ", ".join(f'"{c}"' for c in ASSIGNMENT_COLUMNS)
+    conn.execute(
+        text(f"INSERT INTO work_requests_archive ({req_cols}) SELECT {req_cols} FROM work_requests WHERE id = ANY(:ids)"),
+        {"ids": ids},
+    )
+    conn.execute(
+        text(
+            f"INSERT INTO request_assignments_archive ({asg_cols}, request_created_at) "
+            f"SELECT {', '.join('a.' + c for c in ASSIGNMENT_COLUMNS)}, r.created_at "
+            "FROM request_assignments a JOIN work_requests r ON r.id = a.request_id WHERE a.request_id = ANY(:ids)"
+        ),
+        {"ids": ids},
+    )
+
+
+# ---------- SQLite : fichiers compressés ----------
+def archive_path(key: str) -> str:
+    return os.path.join(RETENTION_DIR, f"work_requests_{key}.jsonl.gz")
+
+
+def _move_to_files(db: Session, requests: List[WorkRequest]) -> Dict[str, int]:
+    """Ajoute un membre gzip par mois ; retourne mois -> position de ce membre dans le fichier."""
+    ids = [r.id for r in requests]
+    assignments: Dict[int, list] = {}
+    for a in db.query(RequestAssignment).filter(RequestAssignment.request_id.in_(ids)):
+        assignments.setdefault(a.request_id, []).append(_jsonable(_row(a, ASSIGNMENT_COLUMNS)))
+
+    by_month: Dict[str, list] = {}
+    for r in requests:
+        row = _jsonable(_row(r, REQUEST_COLUMNS))
+        row["assignments"] = assignments.get(r.id, [])
+        by_month.setdefault(month_key(r.created_at), []).append(row)
+
+    os.makedirs(RETENTION_DIR, exist_ok=True)
+    offsets = {}
+    for key, rows in by_month.items():
+        # un membre gzip de plus par lot ; gzip relit les membres concaténés comme un seul flux.
+        # Écrit AVANT la suppression : un crash entre les deux ne fait que dupliquer des lignes
+        # (l'index pointe alors sur le membre du lot rejoué).
+        with open(archive_path(key), "ab") as raw:
+            offsets[key] = raw.tell()
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for row in rows:
+                    f.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+    return offsets
+
+
+# ---------- Cycle ----------
+def _expired(before: datetime):
+    conds = [WorkRequest.created_at < before]
+    if RETENTION_TERMINAL_STATUSES:
+        conds.append(WorkRequest.status.in_(RETENTION_TERMINAL_STATUSES))
+    # sans date, pas de mois d'archive : la demande reste dans la table chaude
+    return and_(WorkRequest.created_at.isnot(None), or_(*conds))
+
+
+def _candidates(db: Session, limit: int, before: datetime):
+    return (
+        db.query(WorkRequest)
+        .options(undefer(WorkRequest.message_minhash))  # archivée avec toutes ses colonnes
+        .filter(_expired(before))
+        .order_by(WorkRequest.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def archive_batch(db: Session, before: datetime, limit: int = RETENTION_BATCH_SIZE) -> int:
+    """Archive un lot et commit. Retourne le nombre de demandes déplacées."""
+    requests = _candidates(db, limit, before)
+    if not requests:
+        return 0
+    ids = [r.id for r in requests]
+    months = sorted({month_key(r.created_at) for r in requests})
+    storage = "partition" if use_partitions() else "file"
+
+    offsets = {}
+    if storage == "partition":
+        _move_to_partitions(db, ids, months)
+    else:
+        offsets = _move_to_files(db, requests)
+
+    for r in requests:
+        key = month_key(r.created_at)
+        db.merge(ArchivedRequest(id=r.id, created_at=r.created_at, month=key, storage=storage, member_offset=offsets.get(key)))
+    db.query(Notification).filter(Notification.request_id.in_(ids)).delete(synchronize_session=False)
+    db.query(LeadBand).filter(LeadBand.request_id.in_(ids)).delete(synchronize_session=False)
+    db.query(RequestAssignment).filter(RequestAssignment.request_id.in_(ids)).delete(synchronize_session=False)
+    db.query(WorkRequest).filter(WorkRequest.id.in_(ids)).delete(synchronize_session=False)
+    db.commit()
+    return len(ids)
+
+
+def vacuum_analyze():
+    """VACUUM/ANALYZE hors transaction (connexion DBAPI en autocommit)."""
+    raw = engine.raw_connection()
+    try:
+        dbapi = raw.driver_connection
+        if engine.dialect.name == "sqlite":
+            previous = dbapi.isolation_level
+            dbapi.isolation_level = None
+            try:
+                for stmt in ("VACUUM", "ANALYZE", "PRAGMA optimize"):
+                    dbapi.execute(stmt)
+            finally:
+                dbapi.isolation_level = previous
+        elif engine.dialect.name == "postgresql":
+            dbapi.autocommit = True
+            try:
+                cur = dbapi.cursor()
+                for table in ("work_requests", "request_assignments", "notifications", "jobs"):
+                    cur.execute(f"VACUUM (ANALYZE) {table}")
+                cur.close()
+            finally:
+                dbapi.autocommit = False
+    finally:
+        raw.close()
+
+
+def run_retention(db: Session, dry_run: bool = False, vacuum: bool = True) -> dict:
+    before = cutoff()
+    if dry_run:
+        return {"cutoff": before.isoformat(), "would_archive": db.query(WorkRequest).filter(_expired(before)).count()}
+
+    moved = 0
+    while True:
+        n = archive_batch(db, before)
+        moved += n
+        if n < RETENTION_BATCH_SIZE:
+            break
+    if vacuum:
+        vacuum_analyze()
+    log.info("rétention: %d demande(s) archivée(s) (avant %s)", moved, before.date())
+    return {"cutoff": before.isoformat(), "archived": moved}
+
+
+# ---------- Lecture unifiée ----------
+def _load_archived(db: Session, entry: ArchivedRequest) -> Optional[dict]:
+    if entry.storage == "partition":
+        start, end = month_bounds(entry.month)
+        row = db.execute(
+            text(
+                f"SELECT {', '.join(REQUEST_COLUMNS)} FROM work_requests_archive "
+                "WHERE id = :id AND created_at >= :start AND created_at < :end"
+            ),
+            {"id": entry.id, "start": start, "end": end},
+        ).mappings().first()
+        return dict(row) if row else None
+
+    path = archive_path(entry.month)
+    if not os.path.exists(path):
+        return None
+    found = None
+    for line in _read_lines(path, entry.member_offset):
+        row = json.loads(line)
+        if row.get("id") == entry.id:
+            found = row  # la dernière occurrence gagne (cf. doublons possibles)
+    return _from_json(found) if found else None
+
+
+def _read_lines(path: str, offset: Optional[int]):
+    """Lignes du membre gzip à `offset` ; tout le fichier si la position est inconnue (archives anciennes)."""
+    if offset is None:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            yield from f
+        return
+    d = zlib.decompressobj(wbits=31)  # un seul membre gzip : s'arrête à sa fin
+    data = bytearray()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while not d.eof:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            data += d.decompress(chunk)
+    yield from data.decode("utf-8").splitlines()
+
+
+def get_request(db: Session, request_id: int):
+    """
+    Demande par id, chaude ou archivée. Retourne l'objet ORM, un namespace avec les mêmes
+    attributs (+ archived=True) pour une demande archivée, ou None.
+    """
+    req = db.get(WorkRequest, request_id)
+    if req is not None:
+        return req
+    entry = db.get(ArchivedRequest, request_id)
+    if entry is None:
+        return None
+    row = _load_archived(db, entry)
+    if row is None:
+        return None
+    row.pop("assignments", None)
+    return SimpleNamespace(archived=True, **{c: row.get(c) for c in REQUEST_COLUMNS})
+
+
+if __name__ == "__main__":
+    from database import WorkerSession, migrate
+
+    parser = argparse.ArgumentParser(description="Rétention des demandes Coop'Bat")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--no-vacuum", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrate()
+    session = WorkerSession()
+    try:
+        print(run_retention(session, dry_run=args.dry_run, vacuum=not args.no_vacuum))
+    finally:
+        session.close()
@@ -0,0 +1,140 @@
+"""
+Writer unique pour SQLite en mode SQLITE_TUNED=1 (désactivable avec SQLITE_SINGLE_WRITER=0).
+
+SQLite n'accepte qu'un écrivain à la fois : plutôt que de laisser les threads de l'API
+se battre pour le verrou ("database is locked"), toutes les écritures passent par un
+thread dédié. Il regroupe les écritures arrivées en même temps dans une seule transaction
+(group commit : un seul fsync pour N demandes), chacune dans son SAVEPOINT pour qu'une
+erreur n'annule pas les autres.
+
+Seules les écritures du process API passent par ce thread. Les workers de jobs (python jobs.py)
+et la rétention écrivent depuis leur propre process, avec des sessions en BEGIN IMMEDIATE
+(database.WorkerSession) : busy_timeout ne vaut que pour une transaction qui prend le verrou
+d'écriture avant de lire. Une transaction différée qui lit puis écrit après le commit d'un autre
+process échoue tout de suite (SQLITE_BUSY_SNAPSHOT), quel que soit busy_timeout. L'export
+analytique ne fait que lire. Des workers de jobs dans le process de l'API
+(JOBS_INPROCESS_WORKERS) contourneraient le writer : main.py refuse de démarrer.
+
+Usage côté API :
+    request_id = run_write(db, lambda s: ...)   # fn(session) -> valeur
+"""
+import os
+import queue
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import DATABASE_URL, SQLITE_TUNED, make_engine
+
+# nécessite SQLITE_TUNED (BEGIN géré par SQLAlchemy, sinon les SAVEPOINT pysqlite sont peu fiables)
+SQLITE_SINGLE_WRITER = (
+    DATABASE_URL.startswith("sqlite")
+    and SQLITE_TUNED
+    and os.getenv("SQLITE_SINGLE_WRITER", "1") == "1"
+)
+SQLITE_GROUP_COMMIT_MAX = int(os.getenv("SQLITE_GROUP_COMMIT_MAX", "64"))
+SQLITE_GROUP_COMMIT_WINDOW_MS = float(os.getenv("SQLITE_GROUP_COMMIT_WINDOW_MS", "2"))
+
+WriteFn = Callable[[Session], Any]
+
+
+class SingleWriter:
+    def __init__(self, session_factory, max_batch: int = SQLITE_GROUP_COMMIT_MAX,
+                 window_ms: float = SQLITE_GROUP_COMMIT_WINDOW_MS):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.window_s = window_ms / 1000.0
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: WriteFn) -> Future:
+        fut: Future = Future()
+        # contexte de l'appelant (chronométrage par requête, cf. profiling.py)
+        self._queue.put((fn, fut, contextvars.copy_context()))
+        return fut
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        # petite fenêtre pour laisser arriver les écritures concurrentes
+        try:
+            while len(batch) < self.max_batch:
+                item = self._queue.get(timeout=self.window_s) if self.window_s else self._queue.get_nowait()
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+        except queue.Empty:
+            pass
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        results = []
+        session = self.session_factory()
+        try:
+            for fn, fut, ctx in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                sp = session.begin_nested()
+                try:
+                    value = ctx.run(fn, session)
+                    sp.commit()
+                    results.append((fut, value, None))
+                except BaseException as e:
+                    sp.rollback()
+                    results.append((fut, None, e))
+            session.commit()
+        except BaseException as e:
+            session.rollback()
+            results = [(fut, None, err or e) for fut, _, err in results]
+        finally:
+            session.close()
+
+        for fut, value, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(value)
+
+
+_writer: Optional[SingleWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> SingleWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            # connexion dédiée, BEGIN IMMEDIATE : le verrou d'écriture est pris d'emblée
+            eng = make_engine(DATABASE_URL, sqlite_begin="BEGIN IMMEDIATE", pool_size=1, max_overflow=0)
+            _writer = SingleWriter(sessionmaker(bind=eng, autocommit=False, autoflush=False))
+        return _writer
+
+
+def run_write(db: Session, fn: WriteFn) -> Any:
+    """
+    Exécute `fn(session)` puis commit. En mode writer unique, `fn` tourne sur le thread
+    writer (avec sa propre session) : ne retourner que des valeurs simples (ids, statuts).
+    """
+    if SQLITE_SINGLE_WRITER:
+        return get_writer().submit(fn).result()
+    value = fn(db)
+    db.commit()
+    return value
@@ -0,0 +1,307 @@
+"""
+Métré (quantity takeoff) côté serveur : à partir des champs d'une demande (couverture,
+zinguerie, options de charpente) on dérive les lignes `couverture_lines`,
+`zinguerie_lines` et `charpente_lines` au format du chiffrage avancé "V2++".
+
+Les coefficients viennent de tables de règles :
+- valeurs par défaut ci-dessous (celles utilisées jusqu'ici côté client),
+- surchargées par CHIFFRAGE.xlsx : feuille "REGLES" optionnelle (colonnes clé / valeur,
+  ex. "tuile_faible_pente.coef_liteaux_ml_m2 | 2.8").
+Le catalogue des modèles (table "Type de tuile" du classeur) permet de reconnaître un
+cover_type qui est un nom de modèle ("TERREAL - DC12 Double Canal 12") : c'est une tuile.
+
+Les lignes suivent celles des archives advanced_*.json (nom, item_id, ordre) ;
+tests/test_takeoff.py compare le moteur aux leads archivés.
+
+Le calcul est mémoïsé sur l'entrée normalisée : une même configuration de toiture
+n'est calculée qu'une fois.
+"""
+import os
+import re
+import copy
+import math
+import hashlib
+import logging
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger("coopbat.takeoff")
+
+CHIFFRAGE_PATH = os.getenv(
+    "CHIFFRAGE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "CHIFFRAGE.xlsx"),
+)
+TAKEOFF_CACHE_SIZE = int(os.getenv("TAKEOFF_CACHE_SIZE", "4096"))
+
+DEFAULT_RULES = {
+    # familles de couverture, reconnues par mots-clés dans cover_type
+    "couverture": {
+        "tuile_faible_pente": {
+            "match": ["faible pente"],
+            "coef_liteaux_ml_m2": 2.8,
+            "coef_contre_liteaux_ml_m2": 1.7,
+        },
+        "tuile_forte_pente": {
+            "match": ["forte pente", "tuile"],
+            "coef_liteaux_ml_m2": 2.8,
+            "coef_contre_liteaux_ml_m2": 2.1,
+        },
+        "ardoise": {
+            "match": ["ardoise"],
+            "coef_liteaux_ml_m2": 0.0,
+            "coef_contre_liteaux_ml_m2": 1.7,
+            "coef_voliges_m2_m2": 1.0,
+        },
+        "zinc": {
+            "match": ["zinc"],
+            "coef_liteaux_ml_m2": 0.0,
+            "coef_contre_liteaux_ml_m2": 1.7,
+            "coef_voliges_m2_m2": 1.0,
+        },
+    },
+    "charpente": {
+        "bois_m3_par_m2": 0.035,
+        "connecteurs_par_m3": 10.0,
+        "contreventement_m2_par_m2": 1.0,
+    },
+}
+
+# item_id du catalogue client (cf. archives advanced_*.json)
+ITEM_IDS = {"tuiles": 1, "liteaux": 4, "contre_liteaux": 5, "ecran": 6}
+
+
+# ---------- Chargement des règles ----------
+def _norm(value: str) -> str:
+    value = unicodedata.normalize("NFKD", (value or "").strip().lower())
+    return " ".join("".join(c for c in value if not unicodedata.combining(c)).split())
+
+
+def _to_float(value) -> float:
+    """Quantité saisie -> float ; illisible, négative, nan ou inf -> 0."""
+    if value is None or isinstance(value, bool):
+        return 0.0
+    if isinstance(value, (int, float)):
+        f = float(value)
+    else:
+        try:
+            f = float(str(value).strip().replace(",", ".").replace(" ", "") or 0)
+        except ValueError:
+            return 0.0
+    return f if math.isfinite(f) and f > 0 else 0.0
+
+
+def _set_path(rules: dict, key: str, value):
+    parts = key.strip().split(".")
+    node = rules
+    if parts[0] in rules["couverture"]:
+        node = rules["couverture"]
+    for p in parts[:-1]:
+        node = node.setdefault(p, {})
+    node[parts[-1]] = _to_float(value)
+
+
+def load_rules(path: str = CHIFFRAGE_PATH) -> Tuple[dict, str]:
+    """Retourne (règles, version). La version change dès que le classeur change."""
+    rules = copy.deepcopy(DEFAULT_RULES)
+    rules["tiles"] = {}
+    if not os.path.exists(path):
+        return rules, "defaults"
+
+    with open(path, "rb") as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    try:
+        import openpyxl
+    except ImportError:
+        log.warning("openpyxl absent : règles par défaut utilisées")
+        return rules, "defaults"
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if "REGLES" in wb.sheetnames:
+            for row in wb["REGLES"].iter_rows(values_only=True):
+                if row and isinstance(row[0], str) and len(row) > 1 and row[1] is not None:
+                    _set_path(rules, row[0], row[1])
+
+        # catalogue "Type de tuile | ... | Tuiles / m²" (modèles de tuiles, avec leur nombre au m²)
+        for ws in wb.worksheets:
+            header_col = None
+            for row in ws.iter_rows(values_only=True):
+                if header_col is None:
+                    if row and row[0] == "Type de tuile" and "Tuiles / m²" in row:
+                        header_col = row.index("Tuiles / m²")
+                    continue
+                if not row or not isinstance(row[0], str):
+                    break
+                n = _to_float(row[header_col])
+                if n > 0:
+                    rules["tiles"][_norm(row[0])] = n
+    finally:
+        wb.close()
+    return rules, version
+
+
+# chargées au premier calcul (openpyxl + lecture du classeur : hors du démarrage de l'API)
+_loaded: Optional[Tuple[dict, str]] = None
+_rules_lock = threading.Lock()
+
+
+def _rules_and_version() -> Tuple[dict, str]:
+    global _loaded
+    if _loaded is None:
+        with _rules_lock:
+            if _loaded is None:
+                _loaded = load_rules()
+    return _loaded
+
+
+def rules() -> dict:
+    return _rules_and_version()[0]
+
+
+def catalog_version() -> str:
+    return _rules_and_version()[1]
+
+
+def reload_rules(path: str = CHIFFRAGE_PATH):
+    global _loaded
+    _loaded = load_rules(path)
+    _takeoff_cached.cache_clear()
+
+
+# ---------- Calcul ----------
+def _line(category: str, name: str, qty: float, unit: str, item_id: Optional[int] = None) -> dict:
+    return {"category": category, "item_id": item_id, "name": name, "qty": round(qty, 2), "unit": unit}
+
+
+def _words(value: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", _norm(value)).split())
+
+
+def _catalog_model(cover_type: str) -> Optional[str]:
+    """Modèle du catalogue cité en entier dans cover_type (le plus long s'il y en a plusieurs)."""
+    ct = f" {_words(cover_type)} "
+    found = [(len(w), name) for name, w in ((name, _words(name)) for name in rules()["tiles"]) if w and f" {w} " in ct]
+    return max(found)[1] if found else None
+
+
+def _cover_family(cover_type: str) -> Optional[dict]:
+    # modèle du catalogue d'abord : "DC12 Double Canal 12" ne cite aucun mot-clé,
+    # "Tuile plate Ardoisé" n'est pas de l'ardoise
+    if _catalog_model(cover_type) is not None:
+        cover_type = "tuile"
+    ct = _norm(cover_type)
+    for family in rules()["couverture"].values():
+        if any(k in ct for k in family["match"]):
+            return family
+    return None
+
+
+def normalize_inputs(
+    cover_type="", cover_surface_m2="", sarking=False, insulation=False, ecran=True,
+    gouttiere_ml="", habillage_rives_ml="", habillage_mur_m2="", couverture_zinc_m2="",
+    tour_cheminee_nb="", charp_options="", charp_surface_m2="",
+) -> tuple:
+    """Clé de mémoïsation : mêmes quantités (à 1 cm près) -> même clé."""
+    if isinstance(charp_options, str):
+        charp_options = charp_options.split(";")
+    options = tuple(dict.fromkeys(o.strip() for o in charp_options or [] if o and o.strip()))  # ordre saisi
+    return (
+        _norm(cover_type),
+        round(_to_float(cover_surface_m2), 2),
+        bool(sarking), bool(insulation), bool(ecran),
+        round(_to_float(gouttiere_ml), 2),
+        round(_to_float(habillage_rives_ml), 2),
+        round(_to_float(habillage_mur_m2), 2),
+        round(_to_float(couverture_zinc_m2), 2),
+        round(_to_float(tour_cheminee_nb), 2),
+        options,
+        round(_to_float(charp_surface_m2), 2),
+    )
+
+
+@lru_cache(maxsize=TAKEOFF_CACHE_SIZE)
+def _takeoff_cached(key: tuple) -> Dict[str, Tuple[dict, ...]]:
+    (cover_type, surface, sarking, insulation, ecran,
+     gouttiere, rives, mur, zinc, cheminee, options, charp_surface) = key
+
+    couverture: List[dict] = []
+    family = _cover_family(cover_type) if surface > 0 else None
+    if family is not None:
+        couverture.append(_line("COUVERTURE", "Tuiles mécaniques (selon modèle)", surface, "m²", ITEM_IDS["tuiles"]))
+        if family.get("coef_liteaux_ml_m2"):
+            couverture.append(_line("COUVERTURE", "Liteaux", surface * family["coef_liteaux_ml_m2"], "ml", ITEM_IDS["liteaux"]))
+        if family.get("coef_contre_liteaux_ml_m2"):
+            couverture.append(_line("COUVERTURE", "Contre-liteaux", surface * family["coef_contre_liteaux_ml_m2"], "ml",
+                                    ITEM_IDS["contre_liteaux"]))
+        if family.get("coef_voliges_m2_m2"):
+            couverture.append(_line("COUVERTURE", "Voliges", surface * family["coef_voliges_m2_m2"], "m²"))
+        if ecran:
+            couverture.append(_line("COUVERTURE", "Écran sous-toiture", surface, "m²", ITEM_IDS["ecran"]))
+        if sarking:
+            couverture.append(_line("ISOLATION", "Sarking (panneaux)", surface, "m²"))
+        if insulation:
+            couverture.append(_line("ISOLATION", "Isolation entre chevrons", surface, "m²"))
+
+    zinguerie: List[dict] = []
+    if gouttiere:
+        zinguerie.append(_line("ZINGUERIE", "Gouttières (pose + fourniture)", gouttiere, "ml"))
+    if rives:
+        zinguerie.append(_line("ZINGUERIE", "Habillage de rives", rives, "ml"))
+    if mur:
+        zinguerie.append(_line("ZINGUERIE", "Habillage mur", mur, "m²"))
+    if zinc:
+        zinguerie.append(_line("ZINGUERIE", "Couverture zinc", zinc, "m²"))
+    if cheminee:
+        zinguerie.append(_line("ZINGUERIE", "Tour de cheminée", cheminee, "u"))
+
+    charpente: List[dict] = []
+    if options:
+        charpente.append(_line("CHARPENTE", f"Type de projet: {', '.join(options)}", 1.0, ""))
+    if charp_surface > 0 and options:
+        r = rules()["charpente"]
+        bois = charp_surface * r["bois_m3_par_m2"]
+        charpente.append(_line("CHARPENTE", "Bois de structure", bois, "m³"))
+        charpente.append(_line("CHARPENTE", "Connecteurs (sabots/équerres)", bois * r["connecteurs_par_m3"], "u"))
+        charpente.append(_line("CHARPENTE", "Contreventement (OSB/CTBX)", charp_surface * r["contreventement_m2_par_m2"], "m²"))
+
+    return {
+        "couverture_lines": tuple(couverture),
+        "zinguerie_lines": tuple(zinguerie),
+        "charpente_lines": tuple(charpente),
+    }
+
+
+def takeoff(**inputs) -> dict:
+    """Lignes V2++ pour les entrées données (voir normalize_inputs)."""
+    cached = _takeoff_cached(normalize_inputs(**inputs))
+    # copies : l'appelant peut modifier le résultat sans polluer le cache
+    out = {k: [dict(line) for line in v] for k, v in cached.items()}
+    out["version"] = "V2++"
+    out["catalog_version"] = catalog_version()
+    return out
+
+
+def takeoff_for_request(req) -> dict:
+    """Métré d'une WorkRequest (ORM ou équivalent avec les mêmes attributs)."""
+    charp_surface = req.surface_m2 if (req.charp_options or req.lot_type == "charpente") else ""
+    return takeoff(
+        cover_type=req.cover_type or "",
+        cover_surface_m2=req.cover_surface_m2 or "",
+        sarking=bool(req.sarking),
+        insulation=bool(req.insulation),
+        gouttiere_ml=req.gouttiere_ml or "",
+        habillage_rives_ml=req.habillage_rives_ml or "",
+        habillage_mur_m2=req.habillage_mur_m2 or "",
+        couverture_zinc_m2=req.couverture_zinc_m2 or "",
+        tour_cheminee_nb=req.tour_cheminee_nb or "",
+        charp_options=req.charp_options or "",
+        charp_surface_m2=charp_surface or "",
+    )
+
+
+def cache_info() -> dict:
+    info = _takeoff_cached.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
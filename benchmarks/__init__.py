@@ -0,0 +1,7 @@
+"""
+Benchmarks de l'API Coop'Bat.
+
+    python -m benchmarks                       # tous les scénarios, compare à baseline.json
+    python -m benchmarks --save-baseline       # met à jour la baseline
+    python benchmarks/sqlite_writes.py         # débit d'écriture SQLite (défaut vs tuned)
+"""
@@ -0,0 +1,179 @@
+"""
+Lance l'API (uvicorn) sur une base neuve remplie par datagen, joue les scénarios,
+enregistre les résultats en JSON et les compare à la baseline.
+
+    python -m benchmarks [--scale small] [--scenarios submissions_burst,login_flood]
+                         [--workers 1] [--save-baseline] [--fail-on-regression]
+
+Les variables d'environnement (SQLITE_TUNED, DB_POOL_*, ...) sont transmises au serveur ;
+--database-url permet de viser un Postgres local (base vide).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import http.client
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, "backend")
+BENCH_DIR = os.path.join(ROOT, "benchmarks")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+ADMIN_TOKEN = "bench-admin-token"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port: int, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("uvicorn s'est arrêté au démarrage")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/ready")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("uvicorn ne répond pas sur /ready")
+
+
+def seed_database(env: dict, scale: str, seed: int) -> dict:
+    # sous-process : database.py lit DATABASE_URL à l'import
+    code = (
+        "import json, sys; sys.path[:0] = [%r, %r];"
+        "from database import SessionLocal, migrate; from benchmarks.datagen import seed; migrate();"
+        "db = SessionLocal(); print(json.dumps(seed(db, %r, %d))); db.close()"
+    ) % (BACKEND_DIR, ROOT, scale, seed)
+    out = subprocess.run([sys.executable, "-c", code], env=env, cwd=BACKEND_DIR,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Retourne les régressions (latence qui monte / débit qui baisse au-delà de la tolérance)."""
+    regressions = []
+    print(f"\n{'scénario':24s} {'métrique':10s} {'baseline':>10s} {'actuel':>10s} {'écart':>8s}")
+    for name, cur in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            print(f"{name:24s} (pas de baseline)")
+            continue
+        for metric, higher_is_better in (("p50_ms", False), ("p99_ms", False), ("req_per_s", True)):
+            b, c = base.get(metric) or 0, cur.get(metric) or 0
+            delta = (c - b) / b if b else 0.0
+            worse = -delta if higher_is_better else delta
+            flag = "  <-- régression" if worse > tolerance else ""
+            print(f"{name:24s} {metric:10s} {b:>10} {c:>10} {delta:>+8.1%}{flag}")
+            if flag:
+                regressions.append((name, metric, b, c))
+    return regressions
+
+
+def main():
+    from benchmarks.scenarios import SCENARIOS, run_calls
+
+    parser = argparse.ArgumentParser(description="Benchmarks de l'API Coop'Bat")
+    parser.add_argument("--scale", choices=["small", "medium", "large"], default="small")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="liste séparée par des virgules")
+    parser.add_argument("--requests", type=int, default=0, help="remplace le nombre de requêtes par scénario")
+    parser.add_argument("--concurrency", type=int, default=0, help="remplace le nombre de clients par scénario")
+    parser.add_argument("--workers", type=int, default=1, help="workers uvicorn")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", default="")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--out", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"scénario(s) inconnu(s): {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        env["ADMIN_TOKEN"] = ADMIN_TOKEN
+        env["ARCHIVES_DIR"] = os.path.join(tmp, "archives")
+        env["PYTHONPATH"] = os.pathsep.join([BACKEND_DIR, ROOT, env.get("PYTHONPATH", "")])
+
+        counts = seed_database(env, args.scale, args.seed)
+        print(f"données: {counts}")
+
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env,
+        )
+        try:
+            wait_ready(port, server)
+            rng = random.Random(args.seed)
+            ctx = {"scale": args.scale, "admin_token": ADMIN_TOKEN}
+            scenarios = {}
+            for name in names:
+                factory, n, concurrency = SCENARIOS[name]
+                calls = factory(rng, args.requests or n, ctx)
+                scenarios[name] = run_calls("127.0.0.1", port, calls, args.concurrency or concurrency)
+                r = scenarios[name]
+                print(f"{name:24s} {r['req_per_s']:>8} req/s  p50 {r['p50_ms']} ms  p99 {r['p99_ms']} ms  "
+                      f"erreurs {r['errors']}")
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    results = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(timespec="seconds"),
+            "git": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                  capture_output=True, text=True).stdout.strip(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "scale": args.scale,
+            "workers": args.workers,
+            "database": "postgresql" if args.database_url.startswith("postgres") else "sqlite",
+            "seed": args.seed,
+            "data": counts,
+        },
+        "scenarios": scenarios,
+    }
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"bench_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nrésultats: {path}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"baseline mise à jour: {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+    else:
+        print("pas de baseline (lancer avec --save-baseline)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Générateur de données synthétiques (reproductible avec une graine) :
+artisans, demandes et assignations en volume, et payloads de leads au format
+des archives lead_*.json.
+"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+COVER_TYPES = [
+    "Tuile mécanique faible pente (25-35%)",
+    "Tuile mécanique forte pente (35-45%)",
+    "Ardoise",
+    "Zinc",
+]
+CHARPENTE_CHOICES = ["Rénovation", "Extension", "Sur-élévation", "Nouveau projet", "Autre"]
+ZINGUERIE_CHOICES = ["Gouttières", "Habillage rives", "Habillage mur", "Couverture zinc", "Tour de cheminée"]
+LOT_TYPES = ["lot", "couverture", "zinguerie", "charpente"]
+STATUSES = ["nouvelle"] * 6 + ["en_traitement"] * 3 + ["termine"]
+
+COMMUNES = [
+    ("toulouse", "31000"), ("Toulouse", "31400"), ("31600", "31600"), ("Muret", "31600"),
+    ("Blagnac", "31700"), ("Colomiers", "31770"), ("Balma", "31130"), ("Tournefeuille", "31170"),
+    ("Albi", "81000"), ("Montauban", "82000"), ("Castres", "81100"), ("Auch", "32000"),
+]
+FIRST_NAMES = ["Jean", "Marie", "Luc", "Sophie", "Paul", "Camille", "Hugo", "Léa", "Karim", "Inès"]
+MESSAGES = [
+    "", "", "Fuite au niveau du faîtage.", "Devis rapide svp", "Toiture à refaire entièrement",
+    "Gouttières bouchées et abîmées.", "Extension de 30 m² côté jardin.",
+]
+
+ARTISAN_PASSWORD = "bench-password"
+
+SCALES = {
+    "small": {"artisans": 50, "requests": 2_000},
+    "medium": {"artisans": 200, "requests": 20_000},
+    "large": {"artisans": 1_000, "requests": 100_000},
+}
+
+
+def artisan_email(i: int) -> str:
+    return f"bench-artisan-{i}@coopbat.fr"
+
+
+def lead_payload(rng: random.Random, user_id: int = 1) -> dict:
+    """Même forme que le champ "payload" des archives lead_*.json."""
+    name = rng.choice(FIRST_NAMES)
+    commune, _ = rng.choice(COMMUNES)
+    return {
+        "user_id": user_id,
+        "couverture_type": rng.choice(COVER_TYPES),
+        "couverture_surface_m2": float(rng.choice([40, 60, 80, 100, 120, 150, 200])),
+        "couverture_isolation": rng.random() < 0.3,
+        "couverture_sarking": rng.random() < 0.4,
+        "couverture_ecran": rng.random() < 0.7,
+        "zinguerie_choices": rng.sample(ZINGUERIE_CHOICES, rng.randint(0, 2)),
+        "charpente_choices": rng.sample(CHARPENTE_CHOICES, rng.randint(0, 2)),
+        "contact_name": name,
+        "contact_commune": commune,
+        "contact_email": f"{name.lower()}.{rng.randint(1, 9999)}@example.fr",
+        "contact_message": rng.choice(MESSAGES),
+    }
+
+
+def work_request_body(payload: dict, rng: random.Random) -> dict:
+    """Corps de POST /requests à partir d'un payload de lead."""
+    zing = payload["zinguerie_choices"]
+    return {
+        "name": payload["contact_name"],
+        "email": payload["contact_email"],
+        "commune": payload["contact_commune"],
+        "surface_m2": str(int(payload["couverture_surface_m2"])),
+        "lot_type": rng.choice(LOT_TYPES),
+        "budget": rng.choice(["", "5000", "10000", "20000"]),
+        "message": payload["contact_message"],
+        "cover_type": payload["couverture_type"],
+        "cover_surface_m2": str(payload["couverture_surface_m2"]),
+        "insulation": payload["couverture_isolation"],
+        "sarking": payload["couverture_sarking"],
+        "gouttiere_ml": str(rng.choice([20, 40, 60])) if "Gouttières" in zing else "",
+        "habillage_rives_ml": str(rng.choice([10, 20])) if "Habillage rives" in zing else "",
+        "habillage_mur_m2": str(rng.choice([5, 10])) if "Habillage mur" in zing else "",
+        "couverture_zinc_m2": str(rng.choice([15, 30])) if "Couverture zinc" in zing else "",
+        "tour_cheminee_nb": str(rng.randint(1, 3)) if "Tour de cheminée" in zing else "",
+        "charp_options": payload["charpente_choices"],
+    }
+
+
+def _work_request_row(rng: random.Random, created_at: datetime) -> dict:
+    body = work_request_body(lead_payload(rng), rng)
+    body["charp_options"] = ";".join(body["charp_options"])
+    body["created_at"] = created_at
+    body["status"] = rng.choice(STATUSES)
+    return body
+
+
+def seed(db, scale: str = "small", seed_value: int = 42, chunk: int = 2_000) -> dict:
+    """Remplit la base (vide) avec le volume demandé. Retourne les compteurs."""
+    from passlib.context import CryptContext
+    from database import ArtisanUser, WorkRequest, RequestAssignment
+    import geo
+
+    rng = random.Random(seed_value)
+    sizes = SCALES[scale]
+    # un seul hash bcrypt pour tous les artisans : le seed reste rapide
+    password_hash = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(ARTISAN_PASSWORD)
+
+    now = datetime.utcnow()
+    artisans = []
+    for i in range(sizes["artisans"]):
+        commune, postcode = rng.choice(COMMUNES)
+        radius_km = rng.choice([0, 10, 25, 50])
+        artisan_commune = rng.choice([commune, postcode])
+        artisans.append({
+            "contact_name": f"{rng.choice(FIRST_NAMES)} Bench {i}",
+            "email": artisan_email(i),
+            "password_hash": password_hash,
+            "commune": artisan_commune,
+            "radius_km": radius_km,
+            "whole_departement": radius_km > 0,
+            **geo.zone_keys(artisan_commune),
+            "phone": "06 00 00 00 00",
+            "zone_note": "",
+            "created_at": now - timedelta(days=rng.randint(0, 700)),
+        })
+    db.execute(insert(ArtisanUser), artisans)
+
+    total = sizes["requests"]
+    for start in range(0, total, chunk):
+        rows = [
+            _work_request_row(rng, now - timedelta(minutes=rng.randint(0, 2 * 365 * 24 * 60)))
+            for _ in range(min(chunk, total - start))
+        ]
+        db.execute(insert(WorkRequest), rows)
+    db.commit()
+
+    # ~30% des demandes prises en charge par 1 ou 2 artisans
+    req_ids = [r for (r,) in db.query(WorkRequest.id).all()]
+    art_ids = [a for (a,) in db.query(ArtisanUser.id).all()]
+    assignments = []
+    for rid in req_ids:
+        if rng.random() < 0.3:
+            for aid in rng.sample(art_ids, rng.randint(1, 2)):
+                assignments.append({"request_id": rid, "artisan_id": aid, "status": "en_traitement", "created_at": now})
+    for start in range(0, len(assignments), chunk):
+        db.execute(insert(RequestAssignment), assignments[start:start + chunk])
+    db.commit()
+
+    return {"artisans": len(art_ids), "requests": len(req_ids), "assignments": len(assignments)}
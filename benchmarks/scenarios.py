@@ -0,0 +1,118 @@
+"""
+Scénarios de charge : chaque scénario produit une liste de requêtes HTTP
+(méthode, chemin, corps JSON, en-têtes) jouées avec N clients concurrents.
+"""
+import json
+import time
+import random
+import threading
+import http.client
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.datagen import ARTISAN_PASSWORD, SCALES, artisan_email, lead_payload, work_request_body
+
+Call = Tuple[str, str, Optional[dict], Dict[str, str]]
+
+
+def submissions_burst(rng: random.Random, n: int, ctx: dict) -> List[Call]:
+    """Rafale de POST /requests (leads réalistes)."""
+    return [("POST", "/requests", work_request_body(lead_payload(rng), rng), {}) for _ in range(n)]
+
+
+def artisan_refresh_storm(rng: random.Random, n: int, ctx: dict) -> List[Call]:
+    """Tous les artisans rafraîchissent la liste des demandes en même temps."""
+    return [("GET", "/requests", None, {}) for _ in range(n)]
+
+
+def login_flood(rng: random.Random, n: int, ctx: dict) -> List[Call]:
+    """Connexions artisans (bcrypt verify côté serveur)."""
+    artisans = SCALES[ctx["scale"]]["artisans"]
+    return [
+        ("POST", "/artisan/login", {"email": artisan_email(rng.randrange(artisans)), "password": ARTISAN_PASSWORD}, {})
+        for _ in range(n)
+    ]
+
+
+def admin_exports(rng: random.Random, n: int, ctx: dict) -> List[Call]:
+    """Exports admin : liste complète + stats de la file de jobs."""
+    headers = {"X-ADMIN-TOKEN": ctx["admin_token"]}
+    calls = []
+    for i in range(n):
+        calls.append(("GET", "/requests", None, headers) if i % 2 == 0 else ("GET", "/admin/jobs/stats", None, headers))
+    return calls
+
+
+# nom -> (fabrique, nombre de requêtes, clients concurrents)
+SCENARIOS = {
+    "submissions_burst": (submissions_burst, 500, 50),
+    "artisan_refresh_storm": (artisan_refresh_storm, 200, 50),
+    "login_flood": (login_flood, 200, 20),
+    "admin_exports": (admin_exports, 40, 4),
+}
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def run_calls(host: str, port: int, calls: List[Call], concurrency: int, timeout: float = 60) -> dict:
+    """Joue les appels avec `concurrency` clients keep-alive. Retourne les métriques."""
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    errors = 0
+    lock = threading.Lock()
+    cursor = iter(range(len(calls)))
+
+    def client():
+        nonlocal errors
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        while True:
+            with lock:
+                i = next(cursor, None)
+            if i is None:
+                break
+            method, path, body, headers = calls[i]
+            data = json.dumps(body).encode() if body is not None else None
+            hdrs = dict(headers, **({"Content-Type": "application/json"} if data else {}))
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=data, headers=hdrs)
+                resp = conn.getresponse()
+                resp.read()
+                dt = time.perf_counter() - t0
+                with lock:
+                    latencies.append(dt)
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=timeout)
+                with lock:
+                    errors += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    ok = sum(c for s, c in statuses.items() if s < 400)
+    return {
+        "requests": len(calls),
+        "concurrency": concurrency,
+        "ok": ok,
+        "errors": errors + sum(c for s, c in statuses.items() if s >= 400),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "elapsed_s": round(elapsed, 3),
+        "req_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(_percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
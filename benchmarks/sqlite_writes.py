@@ -0,0 +1,105 @@
+"""
+Débit d'écriture SQLite : mode par défaut vs SQLITE_TUNED=1 (WAL + writer unique / group commit).
+
+Chaque client appelle `create_request` (même chemin que POST /requests, sans HTTP) dans
+son propre thread et sa propre session. Chaque mode tourne dans un sous-process avec
+une base neuve.
+
+    python benchmarks/sqlite_writes.py --clients 50 --writes 40
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import threading
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+MODES = {
+    "default": {"SQLITE_TUNED": "0"},
+    "tuned": {"SQLITE_TUNED": "1"},
+}
+
+
+def run_clients(clients: int, writes: int) -> dict:
+    sys.path.insert(0, BACKEND_DIR)
+    from fastapi import HTTPException
+    from sqlalchemy.exc import OperationalError
+
+    import main
+    from database import SessionLocal, migrate
+
+    migrate()
+
+    ok = errors = 0
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def client(i: int):
+        nonlocal ok, errors
+        start_gate.wait()
+        for j in range(writes):
+            db = SessionLocal()
+            try:
+                main.create_request(
+                    main.WorkRequestIn(name=f"bench {i}", email="bench@coopbat.fr", commune="toulouse",
+                                       surface_m2=str(50 + j), lot_type="couverture"),
+                    db,
+                )
+                with lock:
+                    ok += 1
+            except (OperationalError, HTTPException):
+                # "database is locked" en mode par défaut
+                db.rollback()
+                with lock:
+                    errors += 1
+            finally:
+                db.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    start_gate.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    return {"ok": ok, "errors": errors, "elapsed_s": round(elapsed, 3), "writes_per_s": round(ok / elapsed, 1)}
+
+
+def run_mode(mode: str, clients: int, writes: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, **MODES[mode])
+        env["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--clients", str(clients), "--writes", str(writes)],
+            env=env, cwd=tmp, capture_output=True, text=True, check=True,
+        )
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--writes", type=int, default=40, help="écritures par client")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_clients(args.clients, args.writes)))
+        return
+
+    results = {mode: run_mode(mode, args.clients, args.writes) for mode in MODES}
+    for mode, r in results.items():
+        print(f"{mode:8s} {r['writes_per_s']:>8} écritures/s  ok={r['ok']} erreurs={r['errors']}  ({r['elapsed_s']} s)")
+    base = results["default"]["writes_per_s"]
+    if base:
+        print(f"gain: x{results['tuned']['writes_per_s'] / base:.1f}")
+
+
+if __name__ == "__main__":
+    main()
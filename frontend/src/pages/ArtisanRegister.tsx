@@ -1,5 +1,5 @@
 import React, { useState } from "react";
-import { Paper, Stack, Typography, TextField, Button } from "@mui/material";
+import { Paper, Stack, Typography, TextField, Button, FormControlLabel, Checkbox } from "@mui/material";
 import { useNavigate } from "react-router-dom";
 import { api } from "../api";
 
@@ -8,7 +8,7 @@ export default function ArtisanRegister() {
   const [contact_name, setName] = useState("");
   const [email, setEmail] = useState("");
   const [commune, setCommune] = useState("");
-  const [radius_km, setRadius] = useState("30");
+  const [whole_departement, setWholeDepartement] = useState(true);
   const [phone, setPhone] = useState("");
   const [zone_note, setZoneNote] = useState("");
   const [password, setPassword] = useState("");
@@ -16,7 +16,7 @@ export default function ArtisanRegister() {
   async function register() {
     await api.post("/artisan/register", {
       contact_name, email, password, commune,
-      radius_km: Number(radius_km || 30),
+      whole_departement,
       phone, zone_note
     });
     nav("/artisan");
@@ -29,7 +29,10 @@ export default function ArtisanRegister() {
         <TextField label="Nom / Société *" value={contact_name} onChange={e => setName(e.target.value)} />
         <TextField label="Email *" value={email} onChange={e => setEmail(e.target.value)} />
         <TextField label="Commune *" value={commune} onChange={e => setCommune(e.target.value)} />
-        <TextField label="Zone intervention (km)" value={radius_km} onChange={e => setRadius(e.target.value)} />
+        <FormControlLabel
+          control={<Checkbox checked={whole_departement} onChange={e => setWholeDepartement(e.target.checked)} />}
+          label="J'interviens dans tout le département (sinon : ma commune seulement)"
+        />
         <TextField label="Téléphone" value={phone} onChange={e => setPhone(e.target.value)} />
         <TextField label="Zone (note)" value={zone_note} onChange={e => setZoneNote(e.target.value)} />
         <TextField label="Mot de passe *" type="password" value={password} onChange={e => setPassword(e.target.value)} />
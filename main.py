@@ -365,7 +365,7 @@ class CoopApp(MDApp):
         email = s.ids.a_email.text.strip()
         phone = s.ids.a_phone.text.strip()
         commune = s.ids.a_commune.text.strip()
-        radius = s.ids.a_radius.text.strip()
+        whole_departement = s.ids.a_whole_departement.active
         zone_note = s.ids.a_zone_note.text.strip()
         password = s.ids.a_password.text.strip()
 
@@ -373,17 +373,12 @@ class CoopApp(MDApp):
             toast("Nom / Email / Commune / Mot de passe obligatoires.")
             return
 
-        try:
-            rk = int(radius) if radius else 30
-        except Exception:
-            rk = 30
-
         payload = {
             "contact_name": contact_name,
             "email": email,
             "phone": phone,
             "commune": commune,
-            "radius_km": rk,
+            "whole_departement": whole_departement,
             "zone_note": zone_note,
             "password": password
         }
@@ -0,0 +1,65 @@
+"""
+Le métré serveur (backend/takeoff.py) doit redonner les lignes des chiffrages archivés
+(archives/advanced_*.json) à partir des leads correspondants (archives/lead_*.json).
+
+    python -m pytest tests
+"""
+import os
+import sys
+import json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+import takeoff  # noqa: E402
+
+
+def _archive(name: str) -> dict:
+    with open(os.path.join(ROOT, "archives", name), encoding="utf-8") as f:
+        return json.load(f)["payload"]
+
+
+def _lead_inputs(lead: dict, **extra) -> dict:
+    return dict(
+        cover_type=lead["couverture_type"],
+        cover_surface_m2=lead["couverture_surface_m2"],
+        sarking=lead["couverture_sarking"],
+        insulation=lead["couverture_isolation"],
+        ecran=lead["couverture_ecran"],
+        **extra,
+    )
+
+
+def test_couverture_matches_archived_lead():
+    # lead 1 puis son chiffrage avancé (V2 : lignes de couverture dans couverture_2)
+    lead = _archive("lead_1_20260214_133438.json")
+    expected = _archive("advanced_1_20260214_141644.json")["payload"]["couverture_2"]["lines"]
+
+    out = takeoff.takeoff(**_lead_inputs(lead))
+    assert out["couverture_lines"] == expected
+
+
+def test_zinguerie_and_charpente_match_archived_lead():
+    # lead 5 puis son chiffrage avancé (V2++) ; les quantités de zinguerie sont saisies
+    # sur le formulaire avancé, le lead n'en donne que la liste
+    lead = _archive("lead_5_20260214_170237.json")
+    expected = _archive("advanced_2_20260214_170520.json")["payload"]
+
+    out = takeoff.takeoff(**_lead_inputs(
+        lead,
+        gouttiere_ml="60", tour_cheminee_nb="3",
+        charp_options=lead["charpente_choices"],
+        charp_surface_m2=lead["couverture_surface_m2"],
+    ))
+    for key in ("couverture_lines", "zinguerie_lines", "charpente_lines"):
+        assert out[key] == expected[key], key
+
+
+def test_catalog_model_is_a_tile():
+    out = takeoff.takeoff(cover_type="TERREAL - DC12 Double Canal 12", cover_surface_m2="10")
+    names = [line["name"] for line in out["couverture_lines"]]
+    assert names[0] == "Tuiles mécaniques (selon modèle)"
+    assert "Liteaux" in names and "Voliges" not in names
+
+    slate_named = takeoff.takeoff(cover_type="TERREAL – Tuile plate Ardoisé 1EL", cover_surface_m2="10")
+    assert "Voliges" not in [line["name"] for line in slate_named["couverture_lines"]]